@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+离线解析/改写基准测试。
+
+读取 bench_corpus/ 下的英文 (en_*.wiki) 和中文 (zh_*.wiki) 讨论页快照，
+逐页计时 edit.py 中的解析和改写函数，输出每页耗时和每 MB 耗时，
+并检查补丁引擎与树方式的结果是否一致。除 -fetch 外不访问网络。
+
+语料有两类：手工构造的边界情况（嵌套 WPBS、无 WPBS、扩展标签等），以及 bench_corpus/sources.json
+中列出的真实讨论页快照。真实快照用 -fetch 下载（需要网络）；清单中 revid 为空时取最新版本并把版本号写回清单，
+之后重新下载得到同一版本。真实页面的文本来自英文/中文维基百科，按 CC BY-SA 4.0 授权，
+作者见清单所列版本的页面历史。
+
+用法:
+    python benchmark.py                    # 运行并与已保存的基准比较
+    python benchmark.py -save              # 运行并把结果保存为新的基准
+    python benchmark.py -fetch             # 按 sources.json 下载真实讨论页快照
+    python benchmark.py -repeat 10 -profile bench_profiles -tracemalloc
+
+基准文件 bench_baseline.json 随代码提交，由 `python benchmark.py -save` 生成；
+更换机器、Python 或 mwparserfromhell 版本后，应先在修改前的代码上重新生成再比较。
+"""
+import os
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2') # 离线运行，不需要 user-config.py
+
+import argparse
+import cProfile
+import glob
+import json
+import platform
+import pstats
+import re
+import time
+import tracemalloc
+
+import pywikibot
+
+import edit
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_corpus')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+SOURCES_FILE = os.path.join(CORPUS_DIR, 'sources.json') # 真实讨论页快照的来源清单
+NEW_BANNERS = ['WikiProject Ships', 'WikiProject Physics'] # 改写测试中要添加的横幅
+
+def offline_canonical_name(zh_template_name: str) -> str | None:
+    """替代 get_canonical_zh_template_name 的离线版本：只做规范化，不解析重定向"""
+    name = zh_template_name.strip().replace('_', ' ')
+    return name[:1].upper() + name[1:] if name else None
+
+def load_corpus(prefix: str) -> dict[str, str]:
+    """读取语料，返回 {文件名: 文本}，按文件名排序"""
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, f'{prefix}_*.wiki'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            corpus[os.path.basename(path)] = f.read()
+    return corpus
+
+def fetch_corpus(sources_file: str):
+    """按来源清单下载真实讨论页快照；revid 为空的页面取最新版本，并把版本号写回清单"""
+    with open(sources_file, 'r', encoding='utf-8') as f:
+        sources = json.load(f)
+    for file_name, source in sources['pages'].items():
+        page = pywikibot.Page(pywikibot.Site(source['lang'], source['family']), source['title'])
+        if source.get('revid'):
+            text = page.getOldVersion(source['revid'])
+        else:
+            text = page.text
+            source['revid'] = page.latest_revision_id
+        with open(os.path.join(CORPUS_DIR, file_name), 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"{file_name}: {source['lang']}.{source['family']} {source['title']} (revid {source['revid']}, "
+              f"{len(text.encode('utf-8'))} 字节)")
+    with open(sources_file, 'w', encoding='utf-8') as f:
+        json.dump(sources, f, ensure_ascii=False, indent=1)
+        f.write('\n')
+
+def missing_snapshots(sources_file: str) -> list[str]:
+    """返回来源清单中尚未下载的快照文件名"""
+    with open(sources_file, 'r', encoding='utf-8') as f:
+        sources = json.load(f)
+    return [name for name in sources['pages'] if not os.path.exists(os.path.join(CORPUS_DIR, name))]
+
+def plan_rewrite(text: str) -> tuple[dict, list, dict]:
+    """
+    为一页中文讨论页构造固定的改写任务：添加 NEW_BANNERS 中尚不存在的横幅，
+    并把第一个已有横幅的重要度提升为 top。返回 (目标映射, 新模板数据, 重要度更新)。
+    """
+    existing_info, _, _, _ = edit.scan_existing_zh_banners(text)
+    target_map = {name: ('top', name) for name in existing_info}
+    target_map.update({name: ('high', name) for name in NEW_BANNERS if name not in existing_info})
+    new_templates_data = [(name, 'high') for name in sorted(NEW_BANNERS) if name not in existing_info]
+    importance_updates = {}
+    for name, (importance, _) in existing_info.items():
+        if edit.compare_importance('top', importance):
+            importance_updates[name] = 'top'
+            break
+    return target_map, new_templates_data, importance_updates
+
+def rewrite_tree(text: str, plan: tuple) -> str:
+    """树方式的完整改写：解析 + 修改语法树 + 重新序列化"""
+    target_map, new_templates_data, importance_updates = plan
+    _, wpbs, wikicode = edit.get_existing_zh_banners(text)
+    return edit.build_zh_talk_text_tree(wikicode, wpbs, target_map, new_templates_data, importance_updates)
+
+def rewrite_patch(text: str, plan: tuple) -> str:
+    """补丁引擎的完整改写：扫描模板区间 + 应用补丁"""
+    target_map, new_templates_data, importance_updates = plan
+    _, wpbs_span, nested, canonical_names = edit.scan_existing_zh_banners(text)
+    return edit.build_zh_talk_text_patch(text, nested, wpbs_span, target_map, new_templates_data,
+                                         importance_updates, canonical_names)
+
+def build_cases(en_corpus: dict[str, str], zh_corpus: dict[str, str]) -> dict[str, list[tuple[str, int, object]]]:
+    """返回 {函数名: [(页面名, 字节数, 无参调用)]}"""
+    cases = {
+        'parse_en_wikiproject_templates': [], 'get_existing_zh_banners': [],
+        'scan_existing_zh_banners': [], 'rewrite_tree': [], 'rewrite_patch': [],
+    }
+    for name, text in en_corpus.items():
+        size = len(text.encode('utf-8'))
+        cases['parse_en_wikiproject_templates'].append(
+            (name, size, lambda text=text: edit.parse_en_wikiproject_templates(text)))
+    for name, text in zh_corpus.items():
+        size = len(text.encode('utf-8'))
+        plan = plan_rewrite(text)
+        cases['get_existing_zh_banners'].append((name, size, lambda text=text: edit.get_existing_zh_banners(text)))
+        cases['scan_existing_zh_banners'].append((name, size, lambda text=text: edit.scan_existing_zh_banners(text)))
+        cases['rewrite_tree'].append((name, size, lambda text=text, plan=plan: rewrite_tree(text, plan)))
+        cases['rewrite_patch'].append((name, size, lambda text=text, plan=plan: rewrite_patch(text, plan)))
+    return cases
+
+def time_case(func, repeat: int) -> tuple[float, float]:
+    """运行 repeat 次，返回 (最短耗时, 平均耗时)，单位毫秒"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings), sum(timings) / len(timings)
+
+def peak_memory_kb(func) -> float:
+    """用 tracemalloc 测量单次调用的峰值内存，单位 KB"""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+def strip_whitespace(text: str) -> str:
+    """去掉全部空白字符。两种引擎插入横幅时的换行位置不同，比对全文时忽略这一差异"""
+    return re.sub(r'\s+', '', text)
+
+def check_engines(zh_corpus: dict[str, str]) -> tuple[list[str], list[str]]:
+    """
+    比对两种引擎在语料上的改写结果，返回 (横幅签名不一致的页面名, 全文不一致的页面名)。
+    全文比对忽略空白，用于发现签名看不出的破坏（例如 <math> 中的 }} 被当成模板结尾）。
+    """
+    signature_mismatches, text_mismatches = [], []
+    for name, text in zh_corpus.items():
+        plan = plan_rewrite(text)
+        tree_text, patch_text = rewrite_tree(text, plan), rewrite_patch(text, plan)
+        if edit.get_banner_signature(tree_text) != edit.get_banner_signature(patch_text):
+            signature_mismatches.append(name)
+        if strip_whitespace(tree_text) != strip_whitespace(patch_text):
+            text_mismatches.append(name)
+    return signature_mismatches, text_mismatches
+
+def run(repeat: int, profile_dir: str | None, trace_memory: bool) -> dict:
+    """运行全部基准测试，返回结果字典"""
+    en_corpus, zh_corpus = load_corpus('en'), load_corpus('zh')
+    results = {}
+    for func_name, func_cases in build_cases(en_corpus, zh_corpus).items():
+        results[func_name] = {}
+        profiler = cProfile.Profile() if profile_dir else None
+        for page_name, size, func in func_cases:
+            func() # 预热
+            if profiler: profiler.enable()
+            best_ms, mean_ms = time_case(func, repeat)
+            if profiler: profiler.disable()
+            entry = {'bytes': size, 'best_ms': round(best_ms, 3), 'mean_ms': round(mean_ms, 3),
+                     'ms_per_mb': round(best_ms / (size / 1048576), 3) if size else None}
+            if trace_memory:
+                entry['peak_kb'] = round(peak_memory_kb(func), 1)
+            results[func_name][page_name] = entry
+        if profiler:
+            os.makedirs(profile_dir, exist_ok=True)
+            profile_path = os.path.join(profile_dir, f'{func_name}.prof')
+            profiler.dump_stats(profile_path)
+            print(f"\n--- cProfile: {func_name} (已保存到 {profile_path}) ---")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    signature_mismatches, text_mismatches = check_engines(zh_corpus)
+    return {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mwparserfromhell': getattr(edit.mwparserfromhell, '__version__', None),
+            'repeat': repeat,
+        },
+        'results': results,
+        'engine_mismatches': signature_mismatches,
+        'engine_text_mismatches': text_mismatches,
+    }
+
+def report(current: dict, baseline: dict | None):
+    """打印结果；有基准时同时打印与基准相比的变化"""
+    base_results = baseline['results'] if baseline else {}
+    for func_name, pages in current['results'].items():
+        print(f"\n== {func_name} ==")
+        print(f"{'页面':<24}{'字节':>10}{'最短(ms)':>12}{'平均(ms)':>12}{'ms/MB':>12}{'对比基准':>10}")
+        for page_name, entry in pages.items():
+            base_entry = base_results.get(func_name, {}).get(page_name)
+            delta = ''
+            if base_entry and base_entry['best_ms']:
+                delta = f"{(entry['best_ms'] / base_entry['best_ms'] - 1) * 100:+.1f}%"
+            ms_per_mb = f"{entry['ms_per_mb']:.1f}" if entry['ms_per_mb'] is not None else '-'
+            line = f"{page_name:<24}{entry['bytes']:>10}{entry['best_ms']:>12.3f}{entry['mean_ms']:>12.3f}{ms_per_mb:>12}{delta:>10}"
+            if 'peak_kb' in entry:
+                line += f"  峰值内存 {entry['peak_kb']:.1f} KB"
+            print(line)
+    if current['engine_mismatches']:
+        print(f"\n!!! 补丁引擎与树方式横幅不一致的页面: {', '.join(current['engine_mismatches'])}")
+    if current['engine_text_mismatches']:
+        print(f"\n!!! 补丁引擎与树方式全文不一致（忽略空白）的页面: {', '.join(current['engine_text_mismatches'])}")
+    if not current['engine_mismatches'] and not current['engine_text_mismatches']:
+        print("\n补丁引擎与树方式在全部语料上结果一致。")
+
+def main():
+    parser = argparse.ArgumentParser(description='edit.py 解析/改写函数的离线基准测试')
+    parser.add_argument('-repeat', type=int, default=5, help='每页重复次数 (默认 5)')
+    parser.add_argument('-profile', metavar='DIR', help='保存每个函数的 cProfile 结果到该目录')
+    parser.add_argument('-tracemalloc', action='store_true', help='测量每页的峰值内存')
+    parser.add_argument('-save', action='store_true', help='把本次结果保存为新的基准')
+    parser.add_argument('-fetch', action='store_true', help='按 sources.json 下载真实讨论页快照后退出（需要网络）')
+    parser.add_argument('-baseline', default=BASELINE_FILE, help=f'基准文件 (默认 {os.path.basename(BASELINE_FILE)})')
+    args = parser.parse_args()
+
+    if args.fetch:
+        fetch_corpus(SOURCES_FILE)
+        return
+    missing = missing_snapshots(SOURCES_FILE)
+    if missing:
+        print(f"注意: 语料缺少 {len(missing)} 个真实讨论页快照 ({', '.join(missing)})，"
+              f"运行 python benchmark.py -fetch 下载后再用 -save 重新生成基准。")
+
+    edit.get_canonical_zh_template_name = offline_canonical_name
+    current = run(max(args.repeat, 1), args.profile, args.tracemalloc)
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"与基准比较: {args.baseline} ({baseline['meta']['date']})")
+    report(current, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"\n基准已保存到 {args.baseline}")
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,86 @@
 # -*- coding: utf-8 -*-
-import pywikibot
+from __future__ import annotations
+import time
+_script_start_time = time.perf_counter() # 用于统计冷启动耗时（包括导入）
+
 import json
+import glob
+import shelve
 import re
-import time
 import os
+import sys
+import threading
+import heapq
+import http.server
+import itertools
+import queue
+import random
+import difflib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    import fcntl # 缓存存储的进程间文件锁
+except ImportError: # Windows 上没有 fcntl，不加锁
+    fcntl = None
+import requests
 import mwparserfromhell  # 使用 mwparserfromhell 处理模板更稳健
-from pywikibot import textlib
+import pywikibot
+from pywikibot.data import api
 from pywikibot.exceptions import (
     NoPageError, IsRedirectPageError, APIError, InvalidTitleError,
-    UnknownSiteError, LockedPageError, OtherPageSaveError
+    UnknownSiteError, LockedPageError, OtherPageSaveError,
+    ServerError, FatalServerError, MaxlagTimeoutError
 )
-from pywikibot.data import api
+# Pywikibot 11.5 起 TimeoutError 改名为 ApiTimeoutError，Server414Error 改为 Client414Error；兼容新旧版本
+ApiTimeoutError = getattr(pywikibot.exceptions, 'ApiTimeoutError', None) or pywikibot.exceptions.TimeoutError
+Client414Error = getattr(pywikibot.exceptions, 'Client414Error', None) or pywikibot.exceptions.Server414Error
+
+_imports_done_time = time.perf_counter()
 
 # --- 配置 ---
-json_file_path = '1.json'  # 输入的 JSON 文件路径
-CACHE_FILE = 'template_mapping_cache.json' # 模板映射缓存文件
+json_file_paths = ['1.json']  # 输入的 JSON 文件路径列表 (可在命令行中用多个文件名覆盖)
+CACHE_FILE = 'template_mapping_cache.json' # 旧的 JSON 模板映射缓存文件（首次运行时导入磁盘存储）
+CACHE_DB_FILE = 'template_mapping_cache' # 模板映射缓存的磁盘存储 (dbm，实际文件名可能带后缀)
+TEMPLATE_MAP_CACHE_SIZE = 20000 # 各缓存在内存中保留的最大条目数，超出时淘汰最久未使用的条目
+ZH_REDIRECT_CACHE_SIZE = 20000
+LANGLINKS_CACHE_SIZE = 5000
+ALIAS_INDEX_FILE = 'template_alias_index.json' # 自动发现的 WPBS / 专题横幅别名索引缓存文件
+ALIAS_INDEX_TTL = 7 * 24 * 3600 # 别名索引的有效期（秒），过期后启动时重新查询
+use_alias_index = True # 启动时加载或构建别名索引
+refresh_alias_index = False # 为 True 时忽略有效期，强制重建别名索引
+status_port = None # 本地状态端点端口 (http://127.0.0.1:端口/status)，None 表示不开启
+status_file = None # 定期重写的状态文件路径 (JSON)，None 表示不写
+STATUS_INTERVAL = 10 # 状态文件的重写间隔（秒）
+STATUS_WINDOWS = (60, 300, 900) # 计算吞吐量和编辑速率的滑动窗口（秒）
 edit_summary = '[[WP:机器人/申请/PexBot|从英维同步专题模板]]：' # 编辑摘要
 dry_run = False  # 设置为 True 进行测试运行，不实际保存页面
 use_bot_flag = True # 编辑时使用机器人标记
+edit_engine = 'patch' # 'patch': 在原文上按字符区间打补丁；'tree': 修改 mwparserfromhell 语法树后重新序列化
+verify_edit_engine = False # 用树方式校验补丁结果的横幅，不一致则回退到树方式（每次编辑多两次完整解析；引擎一致性平时由 benchmark.py 在语料上检查）
+process_workers = 0 # 解析和编辑计算使用的子进程数，0 表示全部在主进程中进行
+quiet_log = False # 安静模式：不输出逐步骤日志和差异，只定期输出进度
+log_sample_rate = 0.0 # 安静模式下仍输出详细日志的处理单元比例 (0~1)
+log_debug = False # 为 True 时总是输出详细日志
+structured_log_file = None # 结构化日志 (JSONL) 文件路径，None 表示不写
+progress_interval = 500 # 安静模式下每处理多少个单元输出一次进度
+# 每个主机的 (最大并发请求数, 每秒最大请求数)，速率为 0 表示不限速
+HOST_LIMITS = {
+    'en.wikipedia.org': (4, 10.0),
+    'zh.wikipedia.org': (2, 5.0),
+    'www.wikidata.org': (4, 10.0),
+}
+http_pool_size = 8 # 每个主机保持的长连接数上限
+max_retry_attempts = 5 # 每个处理单元的最大尝试次数（遇到暂时性错误时），1 表示不重试
+# 错误类别 -> (首次重试的基础延迟秒数, 最大延迟秒数)，每次重试延迟加倍并加入随机抖动
+RETRY_BACKOFF = {
+    'ratelimit': (30.0, 600.0),
+    'maxlag': (10.0, 300.0),
+    'server': (5.0, 300.0),
+    'timeout': (5.0, 120.0),
+    'connection': (5.0, 120.0),
+}
+resolver_backend = 'langlinks' # 英文 -> 中文映射的解析后端：'langlinks'（先批量查询英文维基语言链接，未命中再查 Wikidata）或 'wikidata'
+LANGLINKS_BATCH_SIZE = 50 # 每次语言链接查询的标题数（API 上限 50）
 
 # --- 英文维基百科排除列表（小写） ---
 excluded_en_projects_lower = {
@@ -33,11 +96,15 @@ zh_wpbs_names_lower = {'wikiproject banner shell', 'wpbs', 'wpbannershell', 'wik
 
 # 默认使用的中文 WPBS 模板名
 default_zh_wpbs_name = 'WikiProject banner shell'
+# 用于自动发现别名的模板：两个维基上的 WPBS，以及中文维基上专题横幅使用的元模板
+WPBS_TEMPLATE_TITLES = {'en': 'Template:WikiProject banner shell', 'zh': 'Template:WikiProject banner shell'}
+ZH_BANNER_META_TITLE = 'Template:WPBannerMeta'
 
 # --- 全局变量 ---
-template_map_cache = {} # 英文模板 -> 中文模板 映射缓存 (从文件加载)
-zh_template_redirect_cache = {} # 中文模板重定向缓存 (内存中)
+resolver_stats = {} # 查询类型 ('page' / 'template') -> {后端: 次数}
 site_objects = {} # 存储站点对象
+zh_banner_aliases = {} # 中文专题横幅名称（含重定向，首字母大写）-> 规范名，由别名索引填充
+offline_template_names = False # 为 True 时（子进程中）模板规范名只查别名索引和缓存，未命中时只做规范化，不访问网络
 processed_counter = 0
 edits_made = 0
 skipped_no_zh_page = 0
@@ -54,6 +121,11 @@ error_wd_fetch = 0
 error_map_fetch = 0
 error_zh_save = 0
 error_other = 0
+skipped_duplicate_titles = 0 # 跨列表去重时跳过的重复标题
+skipped_duplicate_pair = 0 # 同一 (英文条目, 中文条目) 对已在本次运行中处理过
+processed_pairs = {} # 已处理的 (英文讨论页标题, 中文讨论页标题) -> 首个处理它的英文标题（重试时据此放行）
+patch_engine_mismatches = 0 # 补丁引擎与树方式结果不一致的次数
+merged_en_sources = 0 # 合并到其他英文来源同一中文讨论页的英文来源数
 
 # --- 缓存函数 ---
 def load_cache(filename):
@@ -70,43 +142,732 @@ def load_cache(filename):
         pywikibot.output(f"缓存文件 {filename} 不存在，将创建新缓存。")
     return {}
 
-def save_cache(cache, filename):
-    """将缓存保存到 JSON 文件"""
+class LRUCache:
+    """
+    有容量上限的 LRU 缓存，用法与 dict 相同（in / [] / []=）。
+    键和字符串值都会被驻留 (sys.intern)，同一模板名在各处只保存一份。
+    超出容量时淘汰最久未使用的条目；提供磁盘存储 store 时写入会同时写到磁盘，
+    内存未命中时再查磁盘，因此内存中只保留热点条目。
+    `in` 判断计入命中/未命中统计，随后的 [] 读取不重复计数。
+    """
+
+    def __init__(self, name: str, max_entries: int, store: shelve.Shelf | None = None):
+        self.name = name
+        self.max_entries = max(max_entries, 1)
+        self.store = store
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = self.store_hits = 0
+
+    def _intern(self, value):
+        return sys.intern(value) if isinstance(value, str) else value
+
+    def _remember(self, key: str, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _find(self, key: str) -> bool:
+        """在内存或磁盘中查找，找到时移到最近使用的位置"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return True
+        if self.store is not None:
+            try:
+                value = self.store[key]
+            except KeyError:
+                return False
+            self.store_hits += 1
+            self._remember(sys.intern(key), self._intern(value))
+            return True
+        return False
+
+    def __contains__(self, key: str) -> bool:
+        found = self._find(key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def has(self, key: str) -> bool:
+        """与 `in` 相同，但不计入统计（用于预取前的过滤）"""
+        return key in self.entries or (self.store is not None and key in self.store)
+
+    def __getitem__(self, key: str):
+        if not self._find(key):
+            raise KeyError(key)
+        return self.entries[key]
+
+    def get(self, key: str, default=None):
+        return self.entries[key] if self._find(key) else default
+
+    def __setitem__(self, key: str, value):
+        key, value = sys.intern(key), self._intern(value)
+        self._remember(key, value)
+        if self.store is not None:
+            self.store[key] = value
+
+    def update(self, items: dict):
+        for key, value in items.items():
+            self[key] = value
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def counters(self) -> dict:
+        """命中、未命中和淘汰计数"""
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions, 'store_hits': self.store_hits}
+
+    def stats(self) -> str:
+        """命中、未命中和淘汰统计"""
+        lookups = self.hits + self.misses
+        hit_rate = f"{self.hits / lookups:.1%}" if lookups else '-'
+        line = (f"{self.name}: 内存 {len(self.entries)}/{self.max_entries} 条，命中 {self.hits}，未命中 {self.misses}"
+                f" (命中率 {hit_rate})，淘汰 {self.evictions}")
+        if self.store_hits:
+            line += f"，从磁盘读回 {self.store_hits}"
+        return line
+
+    def sync(self):
+        """把磁盘存储的缓冲写入文件"""
+        if self.store is not None:
+            self.store.sync()
+
+    def close(self):
+        """关闭磁盘存储，之后只使用内存"""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+_cache_lock_file = None # 持有共享缓存存储排他锁的文件对象，None 表示本进程没有持有锁
+_private_store_filename = None # 未拿到锁时本进程专用存储的文件名
+
+def lock_cache_store(db_filename: str):
+    """
+    对 <db>.lock 加排他锁（不等待），返回持有锁的文件对象；锁已被其他进程持有时返回 None。
+    dbm.dumb 等后端本身不加锁，多个进程同时写同一存储会丢失记录，因此用单独的锁文件。
+    """
+    lock_file = open(f"{db_filename}.lock", 'a')
+    if fcntl is None:
+        return lock_file
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
-        pywikibot.output(f"模板映射缓存已成功保存到 {filename} ({len(cache)} 条记录)。")
-    except IOError as e:
-        pywikibot.error(f"无法写入缓存文件 {filename}: {e}")
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def private_store_files(db_filename: str) -> dict[str, int]:
+    """查找其他进程留下的专用存储，返回 {存储文件名 (不含 dbm 后缀): 进程号}"""
+    stores = {}
+    for path in glob.glob(f"{glob.escape(db_filename)}.shard-*"):
+        match = re.match(re.escape(db_filename) + r'\.shard-(\d+)', path)
+        if match:
+            stores[match.group(0)] = int(match.group(1))
+    return stores
+
+def remove_store_files(store_filename: str):
+    """删除一个 dbm 存储的全部文件（不同后端的后缀不同）"""
+    for path in [store_filename, *glob.glob(f"{glob.escape(store_filename)}.*")]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def merge_private_stores(db_filename: str, store: shelve.Shelf):
+    """持有锁时调用：把已结束的进程留下的专用存储并入共享存储，然后删除它们"""
+    for store_filename, pid in private_store_files(db_filename).items():
+        if pid != os.getpid():
+            try:
+                os.kill(pid, 0)
+                continue # 该进程仍在运行，由它自己结束时合并
+            except ProcessLookupError:
+                pass
+            except OSError:
+                continue
+        try:
+            merged = 0
+            with shelve.open(store_filename, 'r') as private_store:
+                for key in private_store.keys():
+                    if key not in store: # 专用存储中复制来的旧记录不覆盖共享存储
+                        store[key] = private_store[key]
+                        merged += 1
+            store.sync()
+            remove_store_files(store_filename)
+            pywikibot.output(f"已把专用缓存存储 {store_filename} 中的 {merged} 条新记录并入 {db_filename}。")
+        except Exception as e:
+            pywikibot.warning(f"合并专用缓存存储 {store_filename} 时出错: {e}")
+
+def open_cache_store(db_filename: str, json_filename: str) -> shelve.Shelf | None:
+    """
+    打开模板映射的磁盘存储 (dbm)。存储为空且存在旧的 JSON 缓存文件时，先把其内容导入。
+    先对 <db>.lock 加锁：拿到锁的进程直接读写共享存储，并合并以前留下的专用存储；
+    锁被其他进程（例如同时运行的另一个分片）持有时，复制共享存储的内容到本进程专用的存储中使用，
+    结束时由 close_cache_store 写回。打开失败时返回 None（只使用内存缓存）。
+    """
+    global _cache_lock_file, _private_store_filename
+    try:
+        lock_file = lock_cache_store(db_filename)
+    except OSError as e:
+        pywikibot.warning(f"无法创建缓存锁文件 {db_filename}.lock: {e}。本次运行只使用内存缓存，映射不会保存。")
+        return None
+    try:
+        if lock_file is not None:
+            store = shelve.open(db_filename)
+            merge_private_stores(db_filename, store)
+        else:
+            private_filename = f"{db_filename}.shard-{os.getpid()}"
+            pywikibot.warning(f"缓存存储 {db_filename} 正被其他进程使用，本次运行使用专用存储 {private_filename}，"
+                              f"结束时写回共享存储。")
+            store = shelve.open(private_filename, 'n')
+            _private_store_filename = private_filename
+            try:
+                with shelve.open(db_filename, 'r') as shared_store: # 只读，不与持有锁的进程争用写入
+                    for key in shared_store.keys():
+                        store[key] = shared_store[key]
+            except Exception as e:
+                pywikibot.warning(f"无法读取共享缓存存储 {db_filename}: {e}，专用存储从空开始。")
+            db_filename = private_filename
     except Exception as e:
-        pywikibot.error(f"保存缓存时发生未知错误: {e}")
+        pywikibot.warning(f"无法打开缓存存储 {db_filename}: {e}。本次运行只使用内存缓存，映射不会保存。")
+        if lock_file is not None:
+            lock_file.close()
+        return None
+    _cache_lock_file = lock_file
+    if not len(store) and os.path.exists(json_filename):
+        legacy_cache = load_cache(json_filename)
+        for key, value in legacy_cache.items():
+            store[key] = value
+        store.sync()
+        pywikibot.output(f"已把 {len(legacy_cache)} 条旧缓存记录从 {json_filename} 导入 {db_filename}。")
+    else:
+        pywikibot.output(f"模板映射缓存存储 {db_filename} 中有 {len(store)} 条记录。")
+    return store
+
+def close_cache_store(db_filename: str):
+    """
+    在缓存存储关闭后调用：释放锁；使用专用存储时尝试拿锁把它并入共享存储。
+    仍拿不到锁时保留专用存储，由下一个拿到锁的进程合并。
+    """
+    global _cache_lock_file, _private_store_filename
+    if _private_store_filename is not None:
+        lock_file = lock_cache_store(db_filename)
+        if lock_file is None:
+            pywikibot.output(f"缓存存储 {db_filename} 仍被其他进程使用，专用存储 {_private_store_filename} 留待之后合并。")
+        else:
+            with shelve.open(db_filename) as store:
+                merge_private_stores(db_filename, store)
+            lock_file.close()
+        _private_store_filename = None
+    if _cache_lock_file is not None:
+        _cache_lock_file.close() # 关闭文件即释放锁
+        _cache_lock_file = None
+
+def save_cache(cache: LRUCache, close: bool = False):
+    """把缓存的磁盘存储写入文件；close 为 True 时同时关闭存储，并释放锁或写回专用存储"""
+    try:
+        if close:
+            cache.close()
+            close_cache_store(CACHE_DB_FILE)
+        else:
+            cache.sync()
+    except Exception as e:
+        pywikibot.error(f"保存缓存 {cache.name} 时发生错误: {e}")
+
+template_map_cache = LRUCache('模板映射缓存', TEMPLATE_MAP_CACHE_SIZE) # 英文模板 -> 中文模板 (main() 中接上磁盘存储)
+zh_template_redirect_cache = LRUCache('中文模板重定向缓存', ZH_REDIRECT_CACHE_SIZE) # 中文模板 -> 规范名 (只在内存中，重定向可能变化)
+langlinks_cache = LRUCache('语言链接缓存', LANGLINKS_CACHE_SIZE) # 英文页面标题 -> 中文语言链接标题 (只在内存中，None 表示需回退到 Wikidata，'' 表示英文页面不存在)
+
+# --- 日志 ---
+# 结果计数器：一个处理单元（一个英文标题或一个中文讨论页）内发生变化的计数器即为其结果，错误优先
+OUTCOME_COUNTERS = [
+    'error_en_talk_fetch', 'error_zh_talk_fetch', 'error_wd_fetch', 'error_map_fetch', 'error_zh_save', 'error_other',
+    'skipped_no_zh_page', 'skipped_no_en_talk', 'skipped_en_talk_redirect', 'skipped_zh_talk_redirect',
+    'skipped_no_relevant_en_banners', 'skipped_no_mapping', 'skipped_no_new_banners_or_importance_updates',
+    'skipped_creation_no_banners', 'skipped_duplicate_pair', 'edits_made',
+]
+verbose_enabled = True # 当前处理单元是否输出逐步骤日志
+active_record = None # 当前处理单元的结构化日志记录
+_log_queue = None # 结构化日志写入队列，None 表示未开启
+_log_thread = None
+
+def vlog(msg: str):
+    """
+    逐步骤的详细日志，只在详细模式（或被抽样/调试选中）时输出。
+    消息需要调用函数（title()、join、sorted 等）才能拼出时，调用方先检查 verbose_enabled，安静模式下不做格式化。
+    """
+    if verbose_enabled:
+        pywikibot.output(msg)
+
+def vwarn(msg: str):
+    """逐步骤的警告，规则同 vlog"""
+    if verbose_enabled:
+        pywikibot.warning(msg)
+
+def begin_log_unit():
+    """开始一个新的处理单元：按安静模式、抽样率和调试开关决定是否输出详细日志"""
+    global verbose_enabled
+    verbose_enabled = (not quiet_log or log_debug or
+                       (log_sample_rate > 0 and random.random() < log_sample_rate))
+
+def new_record(stage: str, **fields) -> dict:
+    """创建一条结构化日志记录"""
+    return {'stage': stage, 'time': round(time.time(), 3), 'timings_ms': {}, 'counters': {}, **fields}
+
+def run_tracked(record: dict, step: str, func, *args):
+    """在 record 下运行 func：记录该步骤的耗时以及期间各结果计数器的变化"""
+    global active_record
+    before = [globals()[name] for name in OUTCOME_COUNTERS]
+    previous_record, active_record = active_record, record
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        record['timings_ms'][step] = round(record['timings_ms'].get(step, 0) + (time.perf_counter() - start) * 1000, 1)
+        active_record = previous_record
+        for name, old_value in zip(OUTCOME_COUNTERS, before):
+            delta = globals()[name] - old_value
+            if delta:
+                record['counters'][name] = record['counters'].get(name, 0) + delta
+
+def annotate_record(**fields):
+    """给当前处理单元的记录添加字段"""
+    if active_record is not None:
+        active_record.update(fields)
+
+def finish_record(record: dict, default_outcome: str):
+    """确定结果并提交记录到后台写入线程"""
+    global throttle_streak
+    if 'outcome' not in record:
+        changed = [name for name in OUTCOME_COUNTERS if name in record['counters']]
+        record['outcome'] = changed[0] if changed else default_outcome
+    if not record['outcome'].startswith('retry'):
+        throttle_streak = 0 # 有单元得到最终结果，说明限流已解除
+    note_unit_completed(record)
+    if _log_queue is not None:
+        _log_queue.put(record) # 序列化和写入都在后台线程中进行
+
+def _structured_log_writer(f, log_queue: queue.Queue):
+    """后台线程：把记录逐行写入已打开的 JSONL 文件，队列空闲时才刷新缓冲区"""
+    with f:
+        while True:
+            record = log_queue.get()
+            if record is None:
+                break
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            if log_queue.empty():
+                f.flush()
+
+def start_structured_log(filename: str) -> bool:
+    """
+    开启结构化日志，每个处理单元写一行 JSON。
+    文件在这里（而不是后台线程中）打开，路径无效时在开始处理前就失败，返回 False。
+    """
+    global _log_queue, _log_thread
+    try:
+        f = open(filename, 'a', encoding='utf-8', buffering=1 << 20)
+    except OSError as e:
+        pywikibot.error(f"无法打开结构化日志文件 {filename}: {e}")
+        return False
+    _log_queue = queue.Queue()
+    _log_thread = threading.Thread(target=_structured_log_writer, args=(f, _log_queue),
+                                   name='jsonl-writer', daemon=True)
+    _log_thread.start()
+    pywikibot.output(f"结构化日志将写入 {filename}")
+    return True
+
+def stop_structured_log():
+    """写完队列中剩余的记录并关闭文件"""
+    global _log_queue, _log_thread
+    if _log_queue is None:
+        return
+    _log_queue.put(None)
+    _log_thread.join()
+    _log_queue = _log_thread = None
+
+def timed_call(func, *args):
+    """在子进程中运行 func 并测量耗时，返回 (结果, 毫秒)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+# --- 重试队列 ---
+class RetryableError(Exception):
+    """暂时性错误（限流、maxlag、5xx、超时等），所在处理单元会被放回重试队列"""
+
+    def __init__(self, error: Exception, error_class: str, counter: str):
+        super().__init__(f"{error_class}: {error}")
+        self.error = error
+        self.error_class = error_class
+        self.counter = counter # 重试次数用尽后计入的错误计数器
+
+retry_queues = {'resolve': [], 'edit': []} # 阶段 -> 堆 [(到期时间, 序号, 处理单元键, 已尝试次数)]
+_retry_sequence = itertools.count()
+retries_scheduled = 0
+retries_exhausted = 0
+# 限流和 maxlag 针对整个账户/站点，而不是单个标题：遇到时暂停全部 HTTP 请求，出错的单元到暂停结束时再试，不消耗其尝试次数
+SITE_WIDE_ERROR_CLASSES = ('ratelimit', 'maxlag')
+throttle_streak = 0 # 连续遇到的站点级限流次数，决定暂停时长；有单元得到最终结果时清零
+throttle_pauses = 0
+transport_paused_until = 0.0 # 暂停结束的时间 (time.monotonic)
+
+def classify_error(error: Exception) -> str | None:
+    """判断错误是否值得重试，返回错误类别；锁定、无效标题、SSL 失败等永久性错误返回 None"""
+    if isinstance(error, OtherPageSaveError) and isinstance(error.reason, Exception):
+        error = error.reason # 保存失败时，API 错误包装在 reason 中
+    if isinstance(error, (LockedPageError, InvalidTitleError, NoPageError, IsRedirectPageError, Client414Error,
+                          FatalServerError)):
+        return None
+    if isinstance(error, MaxlagTimeoutError):
+        return 'maxlag'
+    if isinstance(error, (requests.exceptions.Timeout, ApiTimeoutError)):
+        return 'timeout'
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return 'connection'
+    if isinstance(error, ServerError):
+        return 'server'
+    code = getattr(error, 'code', '') or '' # APIError 的错误代码；5xx 响应已由上面的 ServerError 覆盖
+    if code == 'ratelimited':
+        return 'ratelimit'
+    if code == 'maxlag':
+        return 'maxlag'
+    if code.startswith('internal_api_error') or code in ('readonly', 'backend-fail-internal'):
+        return 'server'
+    return None
+
+def raise_if_retryable(error: Exception, counter: str):
+    """在 except 块开头调用：暂时性错误改为抛出 RetryableError，由运行阶段稍后重试"""
+    if isinstance(error, RetryableError):
+        raise error # 内层函数已经转换过，原样向上传递
+    if max_retry_attempts <= 1:
+        return
+    error_class = classify_error(error)
+    if error_class:
+        raise RetryableError(error, error_class, counter) from error
+
+def schedule_retry(stage: str, key, error: RetryableError, attempt: int, record: dict | None = None) -> bool:
+    """
+    按错误类别以指数退避加随机抖动把处理单元放回重试队列。
+    站点级限流（SITE_WIDE_ERROR_CLASSES）按连续限流次数暂停全部请求，单元在暂停结束时重试且不消耗尝试次数；
+    连续限流超过 max_retry_attempts * 2 次后按普通错误处理，避免无限等待。
+    超过最大尝试次数时计入原错误计数器并返回 False。
+    """
+    global retries_scheduled, retries_exhausted, throttle_streak, throttle_pauses, transport_paused_until
+    site_wide = error.error_class in SITE_WIDE_ERROR_CLASSES and throttle_streak < max_retry_attempts * 2
+    if attempt >= max_retry_attempts and not site_wide:
+        globals()[error.counter] += 1
+        retries_exhausted += 1
+        if record is not None:
+            record['counters'][error.counter] = record['counters'].get(error.counter, 0) + 1
+        pywikibot.error(f"!!! '{key}' 已尝试 {attempt} 次仍失败 ({error})，放弃。")
+        return False
+    base_delay, max_delay = RETRY_BACKOFF[error.error_class]
+    now = time.monotonic()
+    if site_wide:
+        throttle_streak += 1
+        delay = min(max_delay, base_delay * 2 ** (throttle_streak - 1))
+        delay = random.uniform(delay / 2, delay)
+        if now + delay > transport_paused_until:
+            transport_paused_until = now + delay
+            throttle_pauses += 1
+            for adapter in transport_adapters.values():
+                adapter.pause_until(transport_paused_until)
+            pywikibot.warning(f"站点级限流 ({error})，暂停全部请求 {delay:.0f} 秒。")
+        due, next_attempt = transport_paused_until, attempt
+    else:
+        delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        due, next_attempt = now + delay, attempt + 1
+    heapq.heappush(retry_queues[stage], (due, next(_retry_sequence), key, next_attempt))
+    retries_scheduled += 1
+    if record is not None:
+        record['retry_in_s'] = round(due - now, 1)
+        record['outcome'] = f"retry_{error.error_class}"
+    vwarn(f"...'{key}' 遇到暂时性错误 ({error})，{due - now:.0f} 秒后进行第 {next_attempt} 次尝试。")
+    return True
+
+def pop_due_retries(stage: str, wait: bool = False) -> list[tuple[object, int]]:
+    """
+    取出已到期的重试单元 [(处理单元键, 尝试次数)]。
+    wait 为 True 且队列非空时，等待到最早的单元到期。
+    """
+    queue_heap = retry_queues[stage]
+    if wait and queue_heap:
+        delay = queue_heap[0][0] - time.monotonic()
+        if delay > 0:
+            vlog(f"等待 {delay:.0f} 秒后处理重试队列 (剩余 {len(queue_heap)} 个)...")
+            time.sleep(delay)
+    due = []
+    now = time.monotonic()
+    while queue_heap and queue_heap[0][0] <= now:
+        _, _, key, attempt = heapq.heappop(queue_heap)
+        due.append((key, attempt))
+    return due
+
+# --- HTTP 传输层 ---
+class HostLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    单个主机的 HTTP 适配器：保持长连接池，限制同时进行的请求数和每秒请求数，
+    并统计请求数、新建连接数和限流等待时间。
+    """
+
+    def __init__(self, host: str, max_concurrency: int, max_rate: float, pool_size: int):
+        super().__init__(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._rate_lock = threading.Lock()
+        self._next_allowed = 0.0
+        self._paused_until = 0.0
+        self.requests_sent = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.throttle_wait = 0.0
+
+    def pause_until(self, deadline: float):
+        """站点级限流时暂停本主机的全部请求，直到 deadline (time.monotonic)"""
+        with self._rate_lock:
+            self._paused_until = max(self._paused_until, deadline)
+
+    def _throttle(self):
+        """按每秒请求数上限等待；暂停期间等待到暂停结束"""
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._paused_until)
+            if self.max_rate > 0:
+                start = max(start, self._next_allowed)
+                self._next_allowed = start + 1.0 / self.max_rate
+            wait = start - now
+        if wait > 0:
+            self.throttle_wait += wait
+            time.sleep(wait)
+
+    def send(self, request, **kwargs):
+        # Accept-Encoding 不需要在这里设置：pywikibot 不覆盖它，requests 默认已发送 'gzip, deflate' 并自动解压
+        with self._semaphore:
+            self._throttle()
+            with self._rate_lock:
+                self.requests_sent += 1
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                return super().send(request, **kwargs)
+            finally:
+                with self._rate_lock:
+                    self.in_flight -= 1
+
+    def connections_opened(self) -> int:
+        """连接池中累计新建的连接数"""
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def stats(self) -> dict:
+        """返回该主机的传输统计"""
+        opened = self.connections_opened()
+        return {
+            'requests': self.requests_sent,
+            'connections_opened': opened,
+            'connection_reuse': round(1 - opened / self.requests_sent, 3) if self.requests_sent else None,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'throttle_wait_s': round(self.throttle_wait, 1),
+        }
+
+transport_adapters = {} # 主机 -> HostLimitedAdapter
+
+def install_transport():
+    """为每个主机在 Pywikibot 共用的 requests 会话上挂载限流的长连接适配器"""
+    from pywikibot.comms import http
+    for host, (max_concurrency, max_rate) in HOST_LIMITS.items():
+        adapter = HostLimitedAdapter(host, max_concurrency, max_rate, max(http_pool_size, max_concurrency))
+        http.session.mount(f'https://{host}/', adapter)
+        transport_adapters[host] = adapter
+    pywikibot.output("HTTP 传输: " + "，".join(
+        f"{host} 并发≤{limits[0]} 速率≤{limits[1]:g}/秒" for host, limits in HOST_LIMITS.items()))
+
+def report_transport_stats():
+    """输出各主机的连接复用等统计"""
+    for host, adapter in transport_adapters.items():
+        stats = adapter.stats()
+        if not stats['requests']:
+            continue
+        pywikibot.output(f"- {host}: 请求 {stats['requests']}，新建连接 {stats['connections_opened']}，"
+                         f"连接复用率 {stats['connection_reuse']:.1%}，最大并发 {stats['max_in_flight']}，"
+                         f"限流等待 {stats['throttle_wait_s']} 秒")
+
+# --- 运行状态 ---
+class StatusRequestHandler(http.server.BaseHTTPRequestHandler):
+    """本地状态端点：GET / 或 /status 返回当前运行状态 (JSON)"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/status'):
+            self.send_error(404)
+            return
+        body = json.dumps(build_status(), ensure_ascii=False, indent=1).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # 不在控制台输出访问日志
+
+run_status = {'stage': 'starting', 'done': 0, 'total': 0} # 当前阶段、已得到最终结果的单元数和总数，由运行阶段更新
+unit_completions = deque() # 最近完成的处理单元 [(完成时间, 阶段, 是否保存了编辑)]，只保留最长窗口内的
+_status_started = time.monotonic()
+_status_server = None
+_status_thread = None
+_status_stop = threading.Event()
+
+def set_run_stage(stage: str, total: int, write_window: deque | None = None):
+    """进入新的运行阶段；write_window 为等待保存的编辑队列（编辑阶段），用于报告待保存数"""
+    run_status.update(stage=stage, done=0, total=total, stage_started=time.time(), write_window=write_window)
+
+def note_unit_completed(record: dict):
+    """
+    记录一个处理单元完成，用于计算滑动窗口内的吞吐量和编辑速率。
+    被放回重试队列的尝试不算完成，单元在得到最终结果时才计入。
+    """
+    if record['outcome'].startswith('retry'):
+        return
+    if record['stage'] == run_status['stage']:
+        run_status['done'] += 1
+    now = time.monotonic()
+    unit_completions.append((now, record['stage'], 'edits_made' in record['counters']))
+    while unit_completions and unit_completions[0][0] < now - max(STATUS_WINDOWS):
+        unit_completions.popleft()
+
+def build_status() -> dict:
+    """汇总当前运行状态：各窗口吞吐量、ETA、计数器、缓存命中率、各站点在途请求和待处理队列"""
+    now = time.monotonic()
+    completions = list(unit_completions) # 复制后再遍历，主线程可能同时追加
+    stage = run_status['stage']
+    throughput = {}
+    edit_rate = {}
+    for window in STATUS_WINDOWS:
+        recent = [entry for entry in completions if entry[0] >= now - window]
+        elapsed = min(window, now - _status_started) or 1 # 刚开始时按实际经过的时间计算
+        throughput[f'{window}s'] = round(sum(1 for entry in recent if entry[1] == stage) / elapsed, 3)
+        edit_rate[f'{window}s'] = round(sum(1 for entry in recent if entry[2]) * 60 / elapsed, 2)
+    remaining = run_status['total'] - run_status['done'] # done 只计得到最终结果的单元，在途和等待重试的都算剩余
+    write_window = run_status.get('write_window')
+    rate = next((value for value in throughput.values() if value > 0), 0) # 优先使用最短的非零窗口
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'uptime_s': round(now - _status_started),
+        'dry_run': dry_run,
+        'stage': stage,
+        'done': run_status['done'],
+        'total': run_status['total'],
+        'units_per_s': throughput,
+        'eta_s': round(remaining / rate) if rate and remaining > 0 else None,
+        'edits_per_min': edit_rate,
+        'counters': {name: globals()[name] for name in OUTCOME_COUNTERS},
+        'retries': {'scheduled': retries_scheduled, 'exhausted': retries_exhausted, 'throttle_pauses': throttle_pauses,
+                    'paused_s': round(max(0.0, transport_paused_until - now), 1),
+                    'queued': {name: len(heap) for name, heap in retry_queues.items()}},
+        'caches': {cache.name: cache.counters() for cache in (template_map_cache, zh_template_redirect_cache, langlinks_cache)},
+        'in_flight': {host: adapter.in_flight for host, adapter in transport_adapters.items()},
+        'pending_log_records': _log_queue.qsize() if _log_queue is not None else 0,
+        'pending_writes': len(write_window or ()) + len(retry_queues['edit']) if stage == 'edit' else None,
+    }
+
+def write_status_file():
+    """把当前状态写入状态文件（先写临时文件再替换，读取方不会看到写了一半的文件）"""
+    temp_file = f"{status_file}.tmp"
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(build_status(), f, ensure_ascii=False, indent=1)
+        os.replace(temp_file, status_file)
+    except Exception as e:
+        pywikibot.warning(f"写入状态文件 {status_file} 失败: {e}")
+
+def _status_file_writer():
+    """后台线程：每 STATUS_INTERVAL 秒重写一次状态文件"""
+    while not _status_stop.wait(STATUS_INTERVAL):
+        write_status_file()
+
+def start_status_reporting():
+    """按配置开启本地状态端点和/或定期重写的状态文件"""
+    global _status_server, _status_thread
+    if status_port:
+        try:
+            _status_server = http.server.ThreadingHTTPServer(('127.0.0.1', status_port), StatusRequestHandler)
+            _status_server.daemon_threads = True
+            threading.Thread(target=_status_server.serve_forever, name='status-http', daemon=True).start()
+            pywikibot.output(f"运行状态端点: http://127.0.0.1:{status_port}/status")
+        except OSError as e:
+            pywikibot.warning(f"无法在端口 {status_port} 上开启状态端点: {e}")
+            _status_server = None
+    if status_file:
+        _status_stop.clear()
+        _status_thread = threading.Thread(target=_status_file_writer, name='status-file', daemon=True)
+        _status_thread.start()
+        pywikibot.output(f"运行状态每 {STATUS_INTERVAL} 秒写入 {status_file}")
+
+def stop_status_reporting():
+    """关闭状态端点，并写入最后一次状态"""
+    global _status_server, _status_thread
+    if _status_server is not None:
+        _status_server.shutdown()
+        _status_server.server_close()
+        _status_server = None
+    if _status_thread is not None:
+        _status_stop.set()
+        _status_thread.join()
+        _status_thread = None
+        run_status['stage'] = 'finished'
+        write_status_file()
 
 # --- 初始化站点 ---
+# 站点代码 -> (语言代码, 站点族)
+SITE_CONFIG = {'en': ('en', 'wikipedia'), 'zh': ('zh', 'wikipedia'), 'wikidata': ('wikidata', 'wikidata')}
+WRITE_SITES = {'zh'} # 需要写入（因此需要登录）的站点；其余站点匿名只读
+
+def _init_site(code: str, need_login: bool) -> pywikibot.site.APISite:
+    """创建站点对象，并在需要时登录（Pywikibot 会复用已缓存的登录会话）"""
+    lang, family = SITE_CONFIG[code]
+    site = pywikibot.Site(lang, family)
+    if need_login:
+        site.login() # 确保登录
+        user = site.user()
+        if not user:
+             pywikibot.warning(f"未能确认在 {lang}.{family} 上的登录用户。请检查认证配置。")
+        else:
+             pywikibot.output(f"成功连接到 {lang}.{family} 并确认为用户: {user}")
+    return site
+
+def get_site(code: str) -> pywikibot.site.APISite:
+    """获取 initialize_sites 中创建的站点对象"""
+    return site_objects[code]
+
 def initialize_sites():
-    """初始化并检查维基站点对象"""
-    global site_objects
-    sites = {'en': 'wikipedia', 'zh': 'wikipedia', 'wikidata': 'wikidata'}
-    all_ok = True
-    for code, family in sites.items():
+    """
+    并行初始化全部站点，并等待它们完成后再开始处理。只有需要写入的站点会登录，
+    只读站点（en、Wikidata）匿名访问。Dry Run 模式下不登录任何站点。
+    """
+    login_codes = set() if dry_run else WRITE_SITES
+    with ThreadPoolExecutor(max_workers=len(SITE_CONFIG), thread_name_prefix='site-init') as executor:
+        site_futures = {code: executor.submit(_init_site, code, code in login_codes) for code in SITE_CONFIG}
+
+    for code, future in site_futures.items():
+        lang, family = SITE_CONFIG[code]
         try:
-            site = pywikibot.Site(code, family)
-            site.login() # 确保登录
-            user = site.user()
-            if not user:
-                 pywikibot.warning(f"未能确认在 {code}.{family} 上的登录用户。请检查认证配置。")
-                 # all_ok = False # 允许继续，但发出警告
-            else:
-                 pywikibot.output(f"成功连接到 {code}.{family} 并确认为用户: {user}")
-            site_objects[code] = site
+            site_objects[code] = future.result()
         except UnknownSiteError as e:
             pywikibot.error(f"无法识别站点: {e}。脚本将退出。")
             return False
         except APIError as e:
-            pywikibot.error(f"初始化站点 {code}.{family} 或检查登录时发生 API 错误 (可能是认证问题): {e}")
+            pywikibot.error(f"初始化站点 {lang}.{family} 或检查登录时发生 API 错误 (可能是认证问题): {e}")
             pywikibot.error("请确保环境已正确配置认证。脚本将退出。")
             return False
         except Exception as e:
-            pywikibot.error(f"初始化站点 {code}.{family} 时发生未知错误: {e}")
+            pywikibot.error(f"初始化站点 {lang}.{family} 时发生未知错误: {e}")
             return False
     # 检查 Wikidata 是否可用
     if 'wikidata' not in site_objects or not site_objects['wikidata']:
@@ -115,20 +876,165 @@ def initialize_sites():
 
     return True
 
+# --- 模板别名索引 ---
+def template_key(name: str) -> str:
+    """模板名的规范形式：去掉首尾空白，下划线转空格，首字母大写（与 MediaWiki 标题规则一致）"""
+    name = name.strip().replace('_', ' ')
+    return name[:1].upper() + name[1:]
+
+def fetch_redirect_groups(site: pywikibot.site.APISite, parameters: dict) -> dict[str, list[str]]:
+    """
+    用 prop=redirects 查询模板及其全部重定向（自动续查），返回 {目标模板名: [重定向模板名]}。
+    名称都不带 Template: 前缀。
+    """
+    groups = {}
+    generator = api.PropertyGenerator('redirects', site=site,
+                                      parameters={'rdnamespace': 10, 'rdlimit': 'max', **parameters})
+    for page in generator:
+        if 'missing' in page or page.get('ns') != 10:
+            continue
+        target = page['title'].split(':', 1)[1]
+        groups.setdefault(target, []).extend(redirect['title'].split(':', 1)[1] for redirect in page.get('redirects', []))
+    return groups
+
+def build_alias_index() -> dict:
+    """
+    从两个维基查询 WPBS 模板的全部重定向，以及中文维基上嵌入 WPBannerMeta 的模板及其重定向。
+    索引只替代重定向解析：收录的每个模板名都映射到 get_canonical_zh_template_name 联网查询会得到的规范名
+    （非重定向模板映射到自身），因此即使其中有不是横幅的模板也不影响结果。
+    跳过子页面（沙盒、文档等），它们不会出现在讨论页上。返回可直接写入 JSON 的索引。
+    """
+    index = {'built': time.time()}
+    for code in ('en', 'zh'):
+        groups = fetch_redirect_groups(get_site(code), {'titles': WPBS_TEMPLATE_TITLES[code]})
+        index[f'{code}_wpbs'] = sorted({name.lower() for target, redirects in groups.items() for name in [target, *redirects]})
+    groups = fetch_redirect_groups(get_site('zh'), {'generator': 'embeddedin', 'geititle': ZH_BANNER_META_TITLE,
+                                                     'geinamespace': 10, 'geilimit': 'max'})
+    index['zh_banners'] = {template_key(name): target for target, redirects in groups.items()
+                           if '/' not in target for name in [target, *redirects]}
+    return index
+
+def install_alias_index(index: dict):
+    """
+    把别名索引并入 WPBS 名称集合和中文横幅别名表（原地修改，手工维护的名称保留）。
+    子进程中由 init_worker_process 调用，使子进程中的扫描使用同一份 WPBS 名称。
+    """
+    en_wpbs_names_lower.update(index.get('en_wpbs', []))
+    zh_wpbs_names_lower.update(index.get('zh_wpbs', []))
+    zh_banner_aliases.update(index.get('zh_banners', {}))
+
+def init_worker_process(index: dict):
+    """
+    进程池的初始化函数：安装别名索引，并禁止子进程访问网络。
+    子进程没有站点对象，其中的计数器也不会传回主进程，所有查询都应在主进程中完成。
+    """
+    global offline_template_names
+    install_alias_index(index)
+    offline_template_names = True
+
+def prepare_alias_index() -> dict | None:
+    """
+    加载或重建别名索引：缓存文件未超过 ALIAS_INDEX_TTL 时直接使用，否则重新查询并写回文件。
+    查询失败时退回过期的缓存文件；两者都没有时只使用手工维护的名称。返回已安装的索引。
+    """
+    cached_index = None
+    if os.path.exists(ALIAS_INDEX_FILE):
+        try:
+            with open(ALIAS_INDEX_FILE, 'r', encoding='utf-8') as f:
+                cached_index = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            pywikibot.warning(f"读取别名索引 {ALIAS_INDEX_FILE} 失败: {e}")
+
+    index = cached_index
+    cache_age = time.time() - cached_index.get('built', 0) if cached_index else None
+    if cached_index is None or refresh_alias_index or cache_age > ALIAS_INDEX_TTL:
+        try:
+            start = time.perf_counter()
+            index = build_alias_index()
+            pywikibot.output(f"已重建模板别名索引，耗时 {time.perf_counter() - start:.1f} 秒。")
+            with open(ALIAS_INDEX_FILE, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False, indent=1)
+        except Exception as e:
+            pywikibot.warning(f"构建模板别名索引时出错: {e}。"
+                              f"{'使用过期的缓存索引。' if cached_index else '只使用手工维护的模板名称。'}")
+            index = cached_index
+    else:
+        pywikibot.output(f"使用缓存的模板别名索引 ({cache_age / 3600:.1f} 小时前构建)。")
+
+    if index:
+        install_alias_index(index)
+        pywikibot.output(f"模板别名索引: 英文 WPBS {len(en_wpbs_names_lower)} 个名称，中文 WPBS {len(zh_wpbs_names_lower)} 个名称，"
+                         f"中文专题横幅 {len(zh_banner_aliases)} 个名称。")
+    return index
+
+# --- 语言链接解析 ---
+def normalize_en_template_name(en_template_name: str) -> str:
+    """规范化英文模板名（移除 Template: 前缀，替换下划线），用作映射缓存的键"""
+    clean_en_name = en_template_name.strip().replace('_', ' ')
+    if clean_en_name.lower().startswith('template:'):
+        return clean_en_name[len('template:'):].strip()
+    return clean_en_name
+
+def note_resolver(kind: str, name: str, backend: str):
+    """记录一次映射查询由哪个后端回答（langlinks / wikidata / cache / none），计入统计并写入当前处理单元的记录"""
+    kind_stats = resolver_stats.setdefault(kind, {})
+    kind_stats[backend] = kind_stats.get(backend, 0) + 1
+    if active_record is not None:
+        active_record.setdefault('resolvers', {})[name] = backend
+
+def prefetch_langlinks(en_titles: list[str]):
+    """
+    批量查询英文页面的中文语言链接 (prop=langlinks&lllang=zh)，每批 LANGLINKS_BATCH_SIZE 个标题，
+    在同一查询中跟随重定向。结果存入 langlinks_cache：中文标题；没有中文链接为 None；英文页面不存在为 ''。
+    查询失败的批次记为 None，之后回退到 Wikidata。
+    """
+    pending = [title for title in dict.fromkeys(en_titles) if title and not langlinks_cache.has(title)]
+    for start in range(0, len(pending), LANGLINKS_BATCH_SIZE):
+        batch = pending[start:start + LANGLINKS_BATCH_SIZE]
+        try:
+            data = get_site('en').simple_request(action='query', prop='langlinks', lllang='zh', lllimit='max',
+                                                  redirects=True, titles=batch).submit()
+        except Exception as e:
+            pywikibot.warning(f"...批量查询 {len(batch)} 个英文页面的语言链接时出错: {e}，这些页面将回退到 Wikidata。")
+            langlinks_cache.update(dict.fromkeys(batch))
+            continue
+        query = data.get('query', {})
+        normalized = {entry['from']: entry['to'] for entry in query.get('normalized', [])}
+        redirects = {entry['from']: entry['to'] for entry in query.get('redirects', [])}
+        pages = query.get('pages', {})
+        pages_by_title = {page['title']: page for page in (pages.values() if isinstance(pages, dict) else pages)}
+        for title in batch:
+            resolved_title = normalized.get(title, title)
+            resolved_title = redirects.get(resolved_title, resolved_title)
+            page = pages_by_title.get(resolved_title)
+            if page is None or 'invalid' in page:
+                langlinks_cache[title] = None # 无法确定，交给 Wikidata 处理
+            elif 'missing' in page:
+                langlinks_cache[title] = ''
+            else:
+                zh_links = [link.get('title', link.get('*')) for link in page.get('langlinks', []) if link.get('lang') == 'zh']
+                langlinks_cache[title] = zh_links[0] if zh_links else None
+
+def lookup_langlink(en_title: str) -> str | None:
+    """返回英文页面的中文语言链接标题；没有中文链接（需回退）为 None，英文页面不存在为 ''。未预取的标题单独查询"""
+    if en_title not in langlinks_cache:
+        prefetch_langlinks([en_title])
+    return langlinks_cache.get(en_title)
+
 # --- Wikidata 相关函数 ---
 def get_itempage_from_page(page: pywikibot.Page) -> pywikibot.ItemPage | None:
     """获取页面对应的 Wikidata ItemPage"""
     try:
         if not page.exists() or page.namespace() < 0 : # 检查存在性和命名空间
-             pywikibot.output(f"...页面 '{page.title()}' 不存在或无效 (ns={page.namespace()})。")
+             if verbose_enabled: vlog(f"...页面 '{page.title()}' 不存在或无效 (ns={page.namespace()})。")
              return None
         if page.isRedirectPage():
              target_page = page.getRedirectTarget()
-             pywikibot.output(f"...页面 '{page.title()}' 重定向到 '{target_page.title()}'，尝试获取目标页的 Item。")
+             if verbose_enabled: vlog(f"...页面 '{page.title()}' 重定向到 '{target_page.title()}'，尝试获取目标页的 Item。")
              page = target_page # 使用重定向目标页
              # 再次检查目标页是否存在
              if not page.exists() or page.namespace() < 0:
-                  pywikibot.output(f"...重定向目标页面 '{page.title()}' 不存在或无效 (ns={page.namespace()})。")
+                  if verbose_enabled: vlog(f"...重定向目标页面 '{page.title()}' 不存在或无效 (ns={page.namespace()})。")
                   return None
 
         # 使用 data_item() 获取 Wikidata 条目
@@ -138,80 +1044,102 @@ def get_itempage_from_page(page: pywikibot.Page) -> pywikibot.ItemPage | None:
             return item
         else:
             # fromPage 没找到会抛 NoPageError 或返回不存在的 ItemPage
-            pywikibot.output(f"...页面 '{page.title()}' 没有找到对应的 Wikidata 条目。")
+            if verbose_enabled: vlog(f"...页面 '{page.title()}' 没有找到对应的 Wikidata 条目。")
             return None
     except NoPageError:
-        pywikibot.output(f"...处理页面 '{page.title()}' 时未找到对应的 Wikidata 条目 (NoPageError)。")
+        if verbose_enabled: vlog(f"...处理页面 '{page.title()}' 时未找到对应的 Wikidata 条目 (NoPageError)。")
         return None
     except APIError as e:
         global error_wd_fetch
+        raise_if_retryable(e, 'error_wd_fetch')
         pywikibot.error(f"...获取页面 '{page.title()}' 的 Wikidata 条目时发生 API 错误: {e}")
         error_wd_fetch += 1
         return None
     except Exception as e:
         global error_other
+        raise_if_retryable(e, 'error_other')
         pywikibot.error(f"...获取页面 '{page.title()}' 的 Wikidata 条目时发生未知错误: {e}")
         error_other += 1
         import traceback; traceback.print_exc()
         return None
 
 def get_zh_page_from_en_title(en_title: str) -> pywikibot.Page | None:
-    """通过 Wikidata 获取英文标题对应的中文维基页面对象，处理重定向"""
+    """通过语言链接（未命中时回退到 Wikidata）获取英文标题对应的中文维基页面对象，处理重定向"""
     global skipped_no_zh_page, error_wd_fetch
-    en_page = pywikibot.Page(site_objects['en'], en_title)
-    # 不再在这里检查英文页面是否存在或重定向，让 get_itempage_from_page 处理
-
-    item = get_itempage_from_page(en_page)
-    if not item:
-        pywikibot.output(f"未能获取英文页面 '{en_title}' 的 Wikidata 条目，无法查找中文链接。")
-        skipped_no_zh_page += 1
-        return None
+    zh_title = None
+    backend = 'wikidata'
+    if resolver_backend == 'langlinks':
+        zh_title = lookup_langlink(en_title)
+        if zh_title == '':
+            vlog(f"英文页面 '{en_title}' 不存在，无法查找中文链接。")
+            note_resolver('page', en_title, 'langlinks')
+            skipped_no_zh_page += 1
+            return None
+        if zh_title:
+            backend = 'langlinks'
+
+    item = None
+    if not zh_title: # 语言链接未命中，回退到 Wikidata
+        en_page = pywikibot.Page(get_site('en'), en_title)
+        # 不再在这里检查英文页面是否存在或重定向，让 get_itempage_from_page 处理
+        item = get_itempage_from_page(en_page)
+        if not item:
+            vlog(f"未能获取英文页面 '{en_title}' 的 Wikidata 条目，无法查找中文链接。")
+            note_resolver('page', en_title, 'none')
+            skipped_no_zh_page += 1
+            return None
 
     try:
-        # get(get_redirect=True) 对 sitelinks 可能不适用，直接获取
-        sitelinks = item.get()['sitelinks']
-        if 'zhwiki' in sitelinks:
-            zh_title = sitelinks['zhwiki'].title
-            zh_page = pywikibot.Page(site_objects['zh'], zh_title)
-            pywikibot.output(f"通过 Wikidata 找到对应中文页面: '{zh_page.title()}'")
-
-            # 检查中文页面是否存在以及是否是重定向
-            if not zh_page.exists():
-                pywikibot.warning(f"Wikidata 指向的中文页面 '{zh_title}' 不存在，跳过。")
+        if item:
+            # get(get_redirect=True) 对 sitelinks 可能不适用，直接获取
+            sitelinks = item.get()['sitelinks']
+            if 'zhwiki' not in sitelinks:
+                if verbose_enabled: vlog(f"Wikidata 条目 {item.title()} 中没有 'zhwiki' 链接，跳过 '{en_title}'。")
+                note_resolver('page', en_title, 'none')
                 skipped_no_zh_page += 1
                 return None
-            if zh_page.isRedirectPage():
-                try:
-                    target_zh_page = zh_page.getRedirectTarget()
-                    # 检查重定向目标是否存在
-                    if not target_zh_page.exists():
-                         pywikibot.warning(f"中文页面 '{zh_page.title()}' 重定向到的目标 '{target_zh_page.title()}' 不存在，跳过。")
-                         skipped_no_zh_page += 1
-                         return None
-                    pywikibot.output(f"...中文页面重定向到: '{target_zh_page.title()}'，使用目标页面。")
-                    return target_zh_page
-                except pywikibot.exceptions.CircularRedirectError:
-                     pywikibot.error(f"处理中文页面 '{zh_page.title()}' 时检测到循环重定向，跳过。")
+            zh_title = sitelinks['zhwiki'].title
+        note_resolver('page', en_title, backend)
+        source = '语言链接' if backend == 'langlinks' else 'Wikidata'
+        zh_page = pywikibot.Page(get_site('zh'), zh_title)
+        if verbose_enabled: vlog(f"通过 {source} 找到对应中文页面: '{zh_page.title()}'")
+
+        # 检查中文页面是否存在以及是否是重定向
+        if not zh_page.exists():
+            vwarn(f"{source} 指向的中文页面 '{zh_title}' 不存在，跳过。")
+            skipped_no_zh_page += 1
+            return None
+        if zh_page.isRedirectPage():
+            try:
+                target_zh_page = zh_page.getRedirectTarget()
+                # 检查重定向目标是否存在
+                if not target_zh_page.exists():
+                     if verbose_enabled: vwarn(f"中文页面 '{zh_page.title()}' 重定向到的目标 '{target_zh_page.title()}' 不存在，跳过。")
                      skipped_no_zh_page += 1
                      return None
-                except Exception as e:
-                    pywikibot.error(f"获取中文页面 '{zh_page.title()}' 的重定向目标时出错: {e}，跳过。")
-                    skipped_no_zh_page += 1
-                    return None
-            else:
-                return zh_page # 非重定向，直接返回
+                if verbose_enabled: vlog(f"...中文页面重定向到: '{target_zh_page.title()}'，使用目标页面。")
+                return target_zh_page
+            except pywikibot.exceptions.CircularRedirectError:
+                 pywikibot.error(f"处理中文页面 '{zh_page.title()}' 时检测到循环重定向，跳过。")
+                 skipped_no_zh_page += 1
+                 return None
+            except Exception as e:
+                raise_if_retryable(e, 'error_other')
+                pywikibot.error(f"获取中文页面 '{zh_page.title()}' 的重定向目标时出错: {e}，跳过。")
+                skipped_no_zh_page += 1
+                return None
         else:
-            pywikibot.output(f"Wikidata 条目 {item.title()} 中没有 'zhwiki' 链接，跳过 '{en_title}'。")
-            skipped_no_zh_page += 1
-            return None
+            return zh_page # 非重定向，直接返回
     except APIError as e:
-        pywikibot.error(f"...获取 Wikidata 条目 {item.title()} 的 sitelinks 时发生 API 错误: {e}")
+        raise_if_retryable(e, 'error_wd_fetch')
+        pywikibot.error(f"...获取英文页面 '{en_title}' 对应的中文页面时发生 API 错误: {e}")
         error_wd_fetch += 1
         skipped_no_zh_page += 1
         return None
     except Exception as e:
         global error_other
-        pywikibot.error(f"...获取 Wikidata 条目 {item.title()} 的 sitelinks 时发生未知错误: {e}")
+        raise_if_retryable(e, 'error_other')
+        pywikibot.error(f"...获取英文页面 '{en_title}' 对应的中文页面时发生未知错误: {e}")
         error_other += 1
         skipped_no_zh_page += 1
         import traceback; traceback.print_exc()
@@ -221,78 +1149,94 @@ def get_zh_template_name_from_en(en_template_name: str) -> str | None:
     """
     查找英文模板对应的中文模板名称。
     优先使用全局缓存 `template_map_cache`。
-    如果缓存未命中，则通过 Wikidata 查询，并将结果存入缓存。
+    如果缓存未命中，则按 resolver_backend 先查语言链接、未命中再查 Wikidata，并将结果存入缓存。
     返回中文模板名（不带 "Template:" 前缀），如果找不到则返回 None。
     """
     global template_map_cache, error_map_fetch, error_wd_fetch
 
     # 规范化英文模板名（移除前缀，替换下划线）
-    clean_en_name = en_template_name.strip().replace('_', ' ')
-    if clean_en_name.lower().startswith('template:'):
-        query_name = clean_en_name[len('template:'):].strip()
-    else:
-        query_name = clean_en_name
+    query_name = normalize_en_template_name(en_template_name)
     if not query_name: return None
 
     # 检查缓存
     if query_name in template_map_cache:
         cached_result = template_map_cache[query_name]
+        note_resolver('template', query_name, 'cache')
         return cached_result # 返回缓存结果，可能是 None
 
-    pywikibot.output(f"开始查找映射: 英文模板 '{query_name}' -> 中文模板?")
+    vlog(f"开始查找映射: 英文模板 '{query_name}' -> 中文模板?")
     zh_template_found_name = None
     try:
-        # 尝试找到英文模板页面 (处理 Template: 前缀和大小写)
-        en_template_page = pywikibot.Page(site_objects['en'], f"Template:{query_name}")
-
-        # 获取对应的 Wikidata Item (get_itempage_from_page 会处理不存在和重定向)
-        item = get_itempage_from_page(en_template_page)
-        if not item:
-             # 如果 Template:xxx 找不到 Item，尝试直接用 xxx 找 (可能是直接页面名)
-             maybe_page = pywikibot.Page(site_objects['en'], query_name)
-             if maybe_page.namespace() == 10: # 确保是模板命名空间
-                  item = get_itempage_from_page(maybe_page)
-
-        if not item: # 如果两种方式都找不到 Item
-             pywikibot.output(f"...英文模板 '{query_name}' 未找到有效的页面或对应的 Wikidata 条目。")
-             template_map_cache[query_name] = None
-             return None
+        zh_link_title = None
+        backend = 'wikidata'
+        if resolver_backend == 'langlinks':
+            zh_link_title = lookup_langlink(f"Template:{query_name}")
+            if zh_link_title == '':
+                vlog(f"...英文模板 'Template:{query_name}' 不存在。")
+                note_resolver('template', query_name, 'langlinks')
+                template_map_cache[query_name] = None
+                return None
+            if zh_link_title:
+                backend = 'langlinks'
+
+        if not zh_link_title: # 语言链接未命中，回退到 Wikidata
+            # 尝试找到英文模板页面 (处理 Template: 前缀和大小写)
+            en_template_page = pywikibot.Page(get_site('en'), f"Template:{query_name}")
+
+            # 获取对应的 Wikidata Item (get_itempage_from_page 会处理不存在和重定向)
+            item = get_itempage_from_page(en_template_page)
+            if not item:
+                 # 如果 Template:xxx 找不到 Item，尝试直接用 xxx 找 (可能是直接页面名)
+                 maybe_page = pywikibot.Page(get_site('en'), query_name)
+                 if maybe_page.namespace() == 10: # 确保是模板命名空间
+                      item = get_itempage_from_page(maybe_page)
+
+            if not item: # 如果两种方式都找不到 Item
+                 vlog(f"...英文模板 '{query_name}' 未找到有效的页面或对应的 Wikidata 条目。")
+                 note_resolver('template', query_name, 'none')
+                 template_map_cache[query_name] = None
+                 return None
+
+            # 从 Wikidata 获取中文链接
+            sitelinks = item.get()['sitelinks'] # get_redirect=True 不适用于sitelinks
+            if 'zhwiki' in sitelinks:
+                zh_link_title = sitelinks['zhwiki'].title
+            else:
+                if verbose_enabled: vlog(f"...Wikidata 条目 {item.title()} 没有中文维基 ('zhwiki') sitelink。")
 
-        # 从 Wikidata 获取中文链接
-        sitelinks = item.get()['sitelinks'] # get_redirect=True 不适用于sitelinks
-        if 'zhwiki' in sitelinks:
-            zh_link_title = sitelinks['zhwiki'].title
+        if zh_link_title:
+            note_resolver('template', query_name, backend)
+            source = '语言链接' if backend == 'langlinks' else 'Wikidata'
             # 提取模板名（移除 Template: 前缀）
             if zh_link_title.lower().startswith('template:'):
                 zh_template_found_name = zh_link_title[len('template:'):].strip()
             else:
                 # 检查链接是否在模板命名空间
-                zh_link_page = pywikibot.Page(site_objects['zh'], zh_link_title)
+                zh_link_page = pywikibot.Page(get_site('zh'), zh_link_title)
                 if zh_link_page.namespace() == 10:
                      zh_template_found_name = zh_link_title.strip() # 如果在模板命名空间，即使没前缀也用
                 else:
-                     pywikibot.warning(f"...Wikidata 找到的中文链接 '{zh_link_title}' 不在 Template 命名空间 (ns={zh_link_page.namespace()})，忽略此映射。")
+                     if verbose_enabled: vwarn(f"...{source} 找到的中文链接 '{zh_link_title}' 不在 Template 命名空间 (ns={zh_link_page.namespace()})，忽略此映射。")
                      zh_template_found_name = None
 
             if zh_template_found_name:
-                 pywikibot.output(f"...通过 Wikidata 找到中文模板: '{zh_template_found_name}'")
+                 vlog(f"...通过 {source} 找到中文模板: '{zh_template_found_name}'")
             # else: (如果解析后为空或命名空间不对) zh_template_found_name 保持 None
-
         else:
-            pywikibot.output(f"...Wikidata 条目 {item.title()} 没有中文维基 ('zhwiki') sitelink。")
-            zh_template_found_name = None
+            note_resolver('template', query_name, 'none')
 
     except InvalidTitleError as e:
         pywikibot.error(f"处理英文模板名 '{query_name}' 时标题无效: {e}")
         error_map_fetch += 1
         zh_template_found_name = None
     except APIError as e:
+        raise_if_retryable(e, 'error_map_fetch') # 暂时性错误不缓存 None，整个处理单元稍后重试
         pywikibot.error(f"查找英文模板 '{query_name}' 的映射时发生 API 错误: {e}")
         error_map_fetch += 1
-        if "ratelimited" in str(e).lower(): time.sleep(10)
         zh_template_found_name = None
     except Exception as e:
         global error_other
+        raise_if_retryable(e, 'error_other')
         pywikibot.error(f"查找英文模板 '{query_name}' 的映射时发生未知错误: {e}")
         error_other += 1
         import traceback; traceback.print_exc()
@@ -314,29 +1258,34 @@ def get_canonical_zh_template_name(zh_template_name: str) -> str | None:
     clean_zh_name = zh_template_name.strip().replace('_', ' ')
     if not clean_zh_name: return None
 
-    # 检查内存缓存
+    # 先查别名索引（已知专题横幅及其重定向），再查内存缓存
+    alias_target = zh_banner_aliases.get(template_key(clean_zh_name))
+    if alias_target:
+        return alias_target
     if clean_zh_name in zh_template_redirect_cache:
         return zh_template_redirect_cache[clean_zh_name]
+    if offline_template_names: # 子进程中：未缓存的名称（例如 <ref> 内的引用模板）不解析重定向
+        return template_key(clean_zh_name)
 
     canonical_name = None
     try:
         # 优先检查带 Template: 前缀的页面
-        zh_template_page = pywikibot.Page(site_objects['zh'], f"Template:{clean_zh_name}")
+        zh_template_page = pywikibot.Page(get_site('zh'), f"Template:{clean_zh_name}")
         page_to_check = zh_template_page
 
         if not zh_template_page.exists():
              # 如果带前缀的不存在，尝试不带前缀的（可能直接引用了名字）
-             maybe_page = pywikibot.Page(site_objects['zh'], clean_zh_name)
+             maybe_page = pywikibot.Page(get_site('zh'), clean_zh_name)
              if maybe_page.exists() and maybe_page.namespace() == 10:
                  page_to_check = maybe_page
-                 # pywikibot.output(f"...检查规范名：'{clean_zh_name}' 作为页面名存在且是模板。")
+                 # vlog(f"...检查规范名：'{clean_zh_name}' 作为页面名存在且是模板。")
              else:
                   # 如果两种方式都找不到，或者找到的不是模板，则认为模板不存在
                   if maybe_page.exists() and maybe_page.namespace() != 10:
-                       # pywikibot.warning(f"...检查规范名：页面 '{clean_zh_name}' 存在但不是模板 (ns={maybe_page.namespace()})。")
+                       # vwarn(f"...检查规范名：页面 '{clean_zh_name}' 存在但不是模板 (ns={maybe_page.namespace()})。")
                        pass # 不是模板，当做无效
                   # else:
-                       # pywikibot.warning(f"...检查规范名：中文模板 'Template:{clean_zh_name}' 或 '{clean_zh_name}' (ns=10) 不存在。")
+                       # vwarn(f"...检查规范名：中文模板 'Template:{clean_zh_name}' 或 '{clean_zh_name}' (ns=10) 不存在。")
                   zh_template_redirect_cache[clean_zh_name] = None
                   return None
 
@@ -347,11 +1296,11 @@ def get_canonical_zh_template_name(zh_template_name: str) -> str | None:
             if target_page.namespace() == 10:
                  target_title = target_page.title(with_ns=False).strip().replace('_', ' ')
                  if target_title:
-                     # pywikibot.output(f"...中文模板 '{clean_zh_name}' (检查的是 '{page_to_check.title()}') 重定向到 -> '{target_title}'")
+                     # vlog(f"...中文模板 '{clean_zh_name}' (检查的是 '{page_to_check.title()}') 重定向到 -> '{target_title}'")
                      canonical_name = target_title
                  else: canonical_name = None # 目标名为空
             else:
-                 pywikibot.warning(f"...中文模板 '{clean_zh_name}' 重定向目标 '{target_page.title()}' 不在模板命名空间 (ns={target_page.namespace()})，视为无效。")
+                 if verbose_enabled: vwarn(f"...中文模板 '{clean_zh_name}' 重定向目标 '{target_page.title()}' 不在模板命名空间 (ns={target_page.namespace()})，视为无效。")
                  canonical_name = None
         else: # 不是重定向
             # 确保页面本身在模板命名空间
@@ -360,16 +1309,18 @@ def get_canonical_zh_template_name(zh_template_name: str) -> str | None:
                  if base_title: canonical_name = base_title
                  else: canonical_name = None # 名字为空？
             else: # 页面不在模板命名空间
-                 # pywikibot.warning(f"...页面 '{page_to_check.title()}' 不是模板命名空间 (ns={page_to_check.namespace()})，视为无效。")
+                 # vwarn(f"...页面 '{page_to_check.title()}' 不是模板命名空间 (ns={page_to_check.namespace()})，视为无效。")
                  canonical_name = None
 
     except InvalidTitleError as e:
         pywikibot.error(f"检查中文模板规范名时标题无效 '{clean_zh_name}': {e}")
         canonical_name = None
     except APIError as e:
+        raise_if_retryable(e, 'error_other')
         pywikibot.error(f"检查中文模板 '{clean_zh_name}' 时发生 API 错误: {e}")
         return None # 不将 None 存入缓存，下次可以重试
     except Exception as e:
+        raise_if_retryable(e, 'error_other')
         pywikibot.error(f"检查中文模板 '{clean_zh_name}' 时发生未知错误: {e}")
         error_other += 1
         import traceback; traceback.print_exc()
@@ -409,197 +1360,549 @@ def compare_importance(en_rating: str | None, zh_rating: str | None) -> bool:
     return en_value > 0 and en_value > zh_value
 
 # --- 解析函数 ---
-def extract_en_wikiproject_templates(talk_page: pywikibot.Page) -> dict[str, str | None]:
+def _is_relevant_en_project(tpl_name_lower: str) -> bool:
+    """检查模板是否是 WikiProject 且不在排除列表"""
+    if not tpl_name_lower.startswith(('wikiproject ', 'wp ')):
+        return False
+    project_name_part = tpl_name_lower.split(' ', 1)[1] if ' ' in tpl_name_lower else ''
+    return f"wikiproject {project_name_part}" not in excluded_en_projects_lower
+
+def parse_en_wikiproject_templates(en_talk_text: str) -> dict[str, str | None]:
     """
     从英文讨论页文本中提取相关的 WikiProject 模板名称及其 importance 参数。
     会查找页面顶层的模板和嵌套在第一个 WPBS 内的模板。
     排除 `excluded_en_projects_lower` 中的项目。
+    只做纯文本解析（不访问网络、不输出日志），可以在子进程中运行。
     返回一个字典 {模板名称: importance值 或 None}。
     """
-    global error_en_talk_fetch, error_other
     relevant_en_templates = {} # 改为字典存储 {name: importance}
-    try:
-        # 存在性和重定向检查已移到 process_page 开头
-        en_talk_text = talk_page.get()
-        wikicode = mwparserfromhell.parse(en_talk_text)
-        templates = wikicode.filter_templates()
-
-        wpbs_processed = False
-        for tpl in templates:
-            tpl_name = str(tpl.name).strip().replace('_', ' ')
-            tpl_name_lower = tpl_name.lower()
-
-            # 提取 importance 的通用逻辑
-            def get_tpl_importance(template_node):
-                if template_node.has('importance', ignore_empty=True):
-                    return str(template_node.get('importance').value).strip()
-                return None
+    wikicode = mwparserfromhell.parse(en_talk_text)
+    templates = wikicode.filter_templates()
 
-            # 检查是否是 WPBS
-            if not wpbs_processed and tpl_name_lower in en_wpbs_names_lower:
-                pywikibot.output(f"...找到英文 WPBS: {tpl_name}")
-                wpbs_processed = True # 只处理第一个找到的 WPBS
-                if tpl.has('1', ignore_empty=True):
-                    param1_val = tpl.get('1').value
-                    nested_wikicode = mwparserfromhell.parse(str(param1_val))
-                    nested_templates = nested_wikicode.filter_templates()
-                    for nested_tpl in nested_templates:
-                        nested_tpl_name = str(nested_tpl.name).strip().replace('_', ' ')
-                        nested_tpl_name_lower = nested_tpl_name.lower()
-                        # 检查是否是 WikiProject 且不在排除列表
-                        is_wp = nested_tpl_name_lower.startswith(('wikiproject ', 'wp '))
-                        is_excluded = False
-                        if is_wp:
-                            project_name_part = nested_tpl_name_lower.split(' ', 1)[1] if ' ' in nested_tpl_name_lower else ''
-                            full_project_name = f"wikiproject {project_name_part}"
-                            is_excluded = full_project_name in excluded_en_projects_lower
-
-                        if is_wp and not is_excluded:
-                            importance = get_tpl_importance(nested_tpl)
-                            # 如果模板已存在（可能顶层和WPBS内都有），优先保留有评级的
-                            if nested_tpl_name not in relevant_en_templates or importance is not None:
-                                relevant_en_templates[nested_tpl_name] = importance
-
-            # 检查顶层模板是否是需要关注的 WikiProject (排除 WPBS 本身)
-            elif tpl_name_lower not in en_wpbs_names_lower:
-                 is_wp = tpl_name_lower.startswith(('wikiproject ', 'wp '))
-                 is_excluded = False
-                 if is_wp:
-                     project_name_part = tpl_name_lower.split(' ', 1)[1] if ' ' in tpl_name_lower else ''
-                     full_project_name = f"wikiproject {project_name_part}"
-                     is_excluded = full_project_name in excluded_en_projects_lower
-
-                 if is_wp and not is_excluded:
-                     importance = get_tpl_importance(tpl)
-                     # 如果模板已存在（可能顶层和WPBS内都有），优先保留有评级的
-                     if tpl_name not in relevant_en_templates or importance is not None:
-                         relevant_en_templates[tpl_name] = importance
+    # 提取 importance 的通用逻辑
+    def get_tpl_importance(template_node):
+        if template_node.has('importance', ignore_empty=True):
+            return str(template_node.get('importance').value).strip()
+        return None
 
+    wpbs_processed = False
+    for tpl in templates:
+        tpl_name = str(tpl.name).strip().replace('_', ' ')
+        tpl_name_lower = tpl_name.lower()
+
+        # 检查是否是 WPBS
+        if not wpbs_processed and tpl_name_lower in en_wpbs_names_lower:
+            wpbs_processed = True # 只处理第一个找到的 WPBS
+            if tpl.has('1', ignore_empty=True):
+                param1_val = tpl.get('1').value
+                nested_wikicode = mwparserfromhell.parse(str(param1_val))
+                nested_templates = nested_wikicode.filter_templates()
+                for nested_tpl in nested_templates:
+                    nested_tpl_name = str(nested_tpl.name).strip().replace('_', ' ')
+                    if _is_relevant_en_project(nested_tpl_name.lower()):
+                        importance = get_tpl_importance(nested_tpl)
+                        # 如果模板已存在（可能顶层和WPBS内都有），优先保留有评级的
+                        if nested_tpl_name not in relevant_en_templates or importance is not None:
+                            relevant_en_templates[nested_tpl_name] = importance
+
+        # 检查顶层模板是否是需要关注的 WikiProject (排除 WPBS 本身)
+        elif tpl_name_lower not in en_wpbs_names_lower:
+             if _is_relevant_en_project(tpl_name_lower):
+                 importance = get_tpl_importance(tpl)
+                 # 如果模板已存在（可能顶层和WPBS内都有），优先保留有评级的
+                 if tpl_name not in relevant_en_templates or importance is not None:
+                     relevant_en_templates[tpl_name] = importance
+
+    return relevant_en_templates
+
+def fetch_en_talk_text(talk_page: pywikibot.Page) -> str | None:
+    """获取英文讨论页文本，出错时返回 None（存在性和重定向检查已移到 resolve_page 开头）"""
+    global error_en_talk_fetch, error_other
+    try:
+        return talk_page.get()
     except APIError as e:
-        pywikibot.error(f"...获取或解析英文讨论页 '{talk_page.title()}' 时发生 API 错误: {e}")
+        raise_if_retryable(e, 'error_en_talk_fetch')
+        pywikibot.error(f"...获取英文讨论页 '{talk_page.title()}' 时发生 API 错误: {e}")
         error_en_talk_fetch += 1
     except Exception as e:
-        pywikibot.error(f"...获取或解析英文讨论页 '{talk_page.title()}' 时发生未知错误: {e}")
+        raise_if_retryable(e, 'error_other')
+        pywikibot.error(f"...获取英文讨论页 '{talk_page.title()}' 时发生未知错误: {e}")
         error_other += 1
         import traceback; traceback.print_exc()
+    return None
 
-    return relevant_en_templates # 返回字典
-
-def get_existing_zh_banners(talk_page: pywikibot.Page) -> tuple[dict[str, tuple[str | None, mwparserfromhell.nodes.Template]], mwparserfromhell.nodes.Template | None, str, mwparserfromhell.wikicode.Wikicode | None]:
+def fetch_zh_talk_text(talk_page: pywikibot.Page) -> str | None:
     """
-    解析中文讨论页，获取第一个 WPBS 模板及其包含的专题横幅信息。
-    返回:
-    - 一个字典 {规范化横幅名称: (importance值 或 None, 对应的模板对象)}。
-    - 第一个找到的 WPBS 的 mwparserfromhell 模板对象 (如果存在)。
-    - 页面原始文本。
-    - 解析后的 mwparserfromhell Wikicode 对象。
+    获取中文讨论页文本。页面不存在时返回空字符串，获取出错时返回 None。
     """
     global error_zh_talk_fetch, error_other
-    existing_banners_info = {} # 改为字典 {canonical_name: (importance, template_node)}
-    zh_wpbs_template_obj = None
-    original_text = ""
-    wikicode = None
-
     try:
         if not talk_page.exists():
-            pywikibot.output(f"...中文讨论页 '{talk_page.title()}' 不存在。")
-            return existing_banners_info, None, "", None
+            if verbose_enabled: vlog(f"...中文讨论页 '{talk_page.title()}' 不存在。")
+            return ""
         # 重定向检查已移到 process_page
-
-        original_text = talk_page.get()
-        wikicode = mwparserfromhell.parse(original_text) # 解析一次，后面复用
-
-        for tpl in wikicode.filter_templates():
-            tpl_name = str(tpl.name).strip().replace('_', ' ')
-            tpl_name_lower = tpl_name.lower()
-
-            # 寻找第一个 WPBS
-            if tpl_name_lower in zh_wpbs_names_lower:
-                pywikibot.output(f"...找到现有的中文 WPBS: {tpl_name}")
-                zh_wpbs_template_obj = tpl # 保存 WPBS 对象引用
-                if tpl.has('1', ignore_empty=True):
-                    param1_val = tpl.get('1').value
-                    # 解析参数1的内容来获取内部模板
-                    # 注意：直接解析 param1.value 可能丢失原始格式，但对于提取模板和参数通常足够
-                    nested_wikicode = mwparserfromhell.parse(str(param1_val))
-                    nested_templates = nested_wikicode.filter_templates()
-                    for nested_tpl in nested_templates:
-                         nested_tpl_raw_name = str(nested_tpl.name).strip().replace('_', ' ')
-                         canonical_name = get_canonical_zh_template_name(nested_tpl_raw_name)
-                         if canonical_name:
-                             importance = None
-                             if nested_tpl.has('importance', ignore_empty=True):
-                                 importance = str(nested_tpl.get('importance').value).strip()
-                             # 存储规范名、重要度和模板节点本身
-                             existing_banners_info[canonical_name] = (importance, nested_tpl)
-                         # else:
-                             # pywikibot.warning(f"...WPBS 内模板 '{nested_tpl_raw_name}' 无法获取规范名。")
-                # 找到第一个 WPBS 后就停止查找其他模板
-                break # <--- 重要：找到后退出循环
-
+        return talk_page.get()
     except APIError as e:
-        pywikibot.error(f"...获取或解析中文讨论页 '{talk_page.title()}' 时发生 API 错误: {e}")
+        raise_if_retryable(e, 'error_zh_talk_fetch')
+        pywikibot.error(f"...获取中文讨论页 '{talk_page.title()}' 时发生 API 错误: {e}")
         error_zh_talk_fetch += 1
-        return {}, None, "", None # 出错时返回空
     except Exception as e:
-        pywikibot.error(f"...获取或解析中文讨论页 '{talk_page.title()}' 时发生未知错误: {e}")
+        raise_if_retryable(e, 'error_other')
+        pywikibot.error(f"...获取中文讨论页 '{talk_page.title()}' 时发生未知错误: {e}")
         error_other += 1
         import traceback; traceback.print_exc()
-        return {}, None, "", None # 出错时返回空
+    return None
 
-    if zh_wpbs_template_obj:
-         existing_names = sorted(existing_banners_info.keys())
-         pywikibot.output(f"...已存在于第一个 WPBS 内的规范化专题模板 ({len(existing_names)}): {', '.join(existing_names)}")
-         # for name, (imp, _) in existing_banners_info.items():
-         #     pywikibot.output(f"    - {name}: importance={imp}") # 日志过多
-    else:
-         pywikibot.output("...未在页面上找到 WPBS 模板。")
+def get_existing_zh_banners(original_text: str) -> tuple[dict[str, tuple[str | None, mwparserfromhell.nodes.Template]], mwparserfromhell.nodes.Template | None, mwparserfromhell.wikicode.Wikicode]:
+    """
+    用 mwparserfromhell 解析中文讨论页，获取第一个 WPBS 模板及其包含的专题横幅信息。
+    返回:
+    - 一个字典 {规范化横幅名称: (importance值 或 None, 对应的模板对象)}。
+    - 第一个找到的 WPBS 的 mwparserfromhell 模板对象 (如果存在)。
+    - 解析后的 mwparserfromhell Wikicode 对象。
+    """
+    existing_banners_info = {} # 改为字典 {canonical_name: (importance, template_node)}
+    zh_wpbs_template_obj = None
+    wikicode = mwparserfromhell.parse(original_text) # 解析一次，后面复用
+
+    for tpl in wikicode.filter_templates():
+        tpl_name = str(tpl.name).strip().replace('_', ' ')
+        tpl_name_lower = tpl_name.lower()
+
+        # 寻找第一个 WPBS
+        if tpl_name_lower in zh_wpbs_names_lower:
+            zh_wpbs_template_obj = tpl # 保存 WPBS 对象引用
+            if tpl.has('1', ignore_empty=True):
+                param1_val = tpl.get('1').value
+                # 解析参数1的内容来获取内部模板
+                # 注意：直接解析 param1.value 可能丢失原始格式，但对于提取模板和参数通常足够
+                nested_wikicode = mwparserfromhell.parse(str(param1_val))
+                nested_templates = nested_wikicode.filter_templates()
+                for nested_tpl in nested_templates:
+                     nested_tpl_raw_name = str(nested_tpl.name).strip().replace('_', ' ')
+                     canonical_name = get_canonical_zh_template_name(nested_tpl_raw_name)
+                     if canonical_name:
+                         importance = None
+                         if nested_tpl.has('importance', ignore_empty=True):
+                             importance = str(nested_tpl.get('importance').value).strip()
+                         # 存储规范名、重要度和模板节点本身
+                         existing_banners_info[canonical_name] = (importance, nested_tpl)
+                     # else:
+                         # vwarn(f"...WPBS 内模板 '{nested_tpl_raw_name}' 无法获取规范名。")
+            # 找到第一个 WPBS 后就停止查找其他模板
+            break # <--- 重要：找到后退出循环
 
     # 返回解析结果，包括 wikicode 对象供后续修改
-    return existing_banners_info, zh_wpbs_template_obj, original_text, wikicode
+    return existing_banners_info, zh_wpbs_template_obj, wikicode
+
+# --- 文本补丁引擎 ---
+# 只识别定位模板所需的语法：注释、nowiki/pre、{{{参数}}}、[[链接]]，其余按普通文本处理
+# 扩展标签：内容对模板解析不透明（其中的 {{ }} | 不参与匹配），与 MediaWiki 预处理器一致。
+# 取自中文维基 Special:Version 的解析器扩展标签；未闭合的标签按普通文本处理（与 mwparserfromhell 一致）
+_EXTENSION_TAGS = (
+    'nowiki', 'pre', 'math', 'chem', 'ce', 'syntaxhighlight', 'source', 'ref', 'references', 'gallery',
+    'templatedata', 'templatestyles', 'timeline', 'score', 'graph', 'hiero', 'imagemap', 'inputbox',
+    'categorytree', 'charinsert', 'poem', 'section', 'indicator', 'mapframe', 'maplink', 'langconvert',
+)
+_EXTENSION_TAG_PATTERN = '|'.join(_EXTENSION_TAGS)
+_SKIP_RE = re.compile(r'<!--.*?(?:-->|\Z)|<(' + _EXTENSION_TAG_PATTERN + r')\b[^>]*?(?:/>|>.*?</\1\s*>)', re.S | re.I)
+_TOP_TOKEN_RE = re.compile(r'\{\{|<!--|<(?:' + _EXTENSION_TAG_PATTERN + r')\b', re.I)
+_INNER_TOKEN_RE = re.compile(r'\{\{|\}\}|\[\[|\]\]|\||=|<!--|<(?:' + _EXTENSION_TAG_PATTERN + r')\b', re.I)
+
+def scan_templates(text: str) -> list[dict]:
+    """
+    扫描文本中的所有模板（包括嵌套模板），按起始位置排序返回，顺序与 filter_templates() 一致。
+    每个模板为 dict: {'name', 'start', 'end', 'name_end', 'params'}，
+    params 中每项为 dict: {'name', 'start', 'end', 'value_start', 'value_end'}，
+    匿名参数的 'name' 为其序号字符串（'1', '2', ...）。
+    """
+    templates = []
+    stack = [] # 每项为 [类型('tpl'/'arg'/'link'), 起始位置, 字段列表]
+    pos = 0
+    length = len(text)
+    while pos < length:
+        token_re = _INNER_TOKEN_RE if stack else _TOP_TOKEN_RE
+        m = token_re.search(text, pos)
+        if not m:
+            break
+        token, pos = m.group(0), m.start()
+        if token.startswith('<'):
+            skip = _SKIP_RE.match(text, pos)
+            pos = skip.end() if skip else pos + 1
+        elif token == '{{':
+            if text.startswith('{{{', pos) and not text.startswith('{{{{', pos):
+                stack.append(['arg', pos, None])
+                pos += 3
+            else:
+                stack.append(['tpl', pos, [[pos + 2, None]]]) # 字段: [起始位置, '=' 位置]
+                pos += 2
+        elif token == '}}':
+            # 未闭合的链接按普通文本处理
+            while stack and stack[-1][0] == 'link':
+                stack.pop()
+            if stack and stack[-1][0] == 'arg' and text.startswith('}}}', pos):
+                stack.pop()
+                pos += 3
+            elif stack and stack[-1][0] == 'tpl':
+                _, start, fields = stack.pop()
+                pos += 2
+                templates.append(_build_template_span(text, start, pos, fields))
+            else:
+                if stack: stack.pop() # 不匹配的 {{{ 按普通文本处理
+                pos += 2
+        elif token == '[[':
+            stack.append(['link', pos, None])
+            pos += 2
+        elif token == ']]':
+            if stack[-1][0] == 'link':
+                stack.pop()
+            pos += 2
+        elif token == '|':
+            if stack[-1][0] == 'tpl':
+                stack[-1][2].append([pos + 1, None])
+            pos += 1
+        else: # '='
+            frame = stack[-1]
+            if frame[0] == 'tpl' and len(frame[2]) > 1 and frame[2][-1][1] is None:
+                frame[2][-1][1] = pos
+            pos += 1
+    templates.sort(key=lambda t: t['start'])
+    return templates
+
+def _build_template_span(text: str, start: int, end: int, fields: list) -> dict:
+    """根据扫描得到的字段位置构建模板区间信息"""
+    name_end = fields[1][0] - 1 if len(fields) > 1 else end - 2
+    params = []
+    positional = 0
+    for index, (field_start, eq_pos) in enumerate(fields[1:], start=1):
+        field_end = fields[index + 1][0] - 1 if index + 1 < len(fields) else end - 2
+        if eq_pos is not None:
+            param_name = text[field_start:eq_pos].strip()
+            value_start = eq_pos + 1
+        else:
+            positional += 1
+            param_name = str(positional)
+            value_start = field_start
+        params.append({'name': param_name, 'start': field_start - 1, 'end': field_end,
+                       'value_start': value_start, 'value_end': field_end})
+    return {'name': text[start + 2:name_end].strip().replace('_', ' '), 'start': start,
+            'end': end, 'name_end': name_end, 'params': params}
+
+def get_template_param(tpl: dict, name: str) -> dict | None:
+    """获取模板区间中的指定参数（同名参数取最后一个，与 mwparserfromhell 的 get() 一致）"""
+    for param in reversed(tpl['params']):
+        if param['name'] == name:
+            return param
+    return None
+
+def scan_zh_wpbs(original_text: str) -> tuple[dict | None, list[dict]]:
+    """
+    只做纯文本扫描（不访问网络），可以在子进程中运行。
+    返回 (第一个 WPBS 的模板区间, 其参数 1 内的全部模板区间)。
+    """
+    templates = scan_templates(original_text)
+    zh_wpbs_span = next((t for t in templates if t['name'].lower() in zh_wpbs_names_lower), None)
+    nested_templates = []
+    if zh_wpbs_span:
+        param1 = get_template_param(zh_wpbs_span, '1')
+        if param1 and original_text[param1['value_start']:param1['value_end']].strip():
+            nested_templates = [t for t in templates
+                                if t['start'] >= param1['value_start'] and t['end'] <= param1['value_end']]
+    return zh_wpbs_span, nested_templates
+
+def get_existing_zh_banners_from_scan(original_text: str, nested_templates: list[dict]) -> tuple[dict[str, tuple[str | None, dict]], dict[str, str]]:
+    """
+    根据 scan_zh_wpbs 的结果解析模板规范名。
+    返回 ({规范化横幅名称: (importance值 或 None, 模板区间)}, {原始模板名: 规范名，无效模板为 None})。
+    """
+    existing_banners_info = {}
+    canonical_names = {}
+    for nested in nested_templates:
+        canonical_name = get_canonical_zh_template_name(nested['name'])
+        canonical_names[nested['name']] = canonical_name
+        if canonical_name:
+            importance = None
+            importance_param = get_template_param(nested, 'importance')
+            if importance_param:
+                importance = original_text[importance_param['value_start']:importance_param['value_end']].strip() or None
+            existing_banners_info[canonical_name] = (importance, nested)
+    return existing_banners_info, canonical_names
+
+def scan_existing_zh_banners(original_text: str) -> tuple[dict[str, tuple[str | None, dict]], dict | None, list[dict], dict[str, str]]:
+    """
+    get_existing_zh_banners 的补丁引擎版本：不构建语法树，只扫描模板区间。
+    返回 ({规范化横幅名称: (importance值 或 None, 模板区间)}, 第一个 WPBS 的模板区间,
+    WPBS 参数 1 内的模板区间, {原始模板名: 规范名})。
+    """
+    zh_wpbs_span, nested_templates = scan_zh_wpbs(original_text)
+    existing_banners_info, canonical_names = get_existing_zh_banners_from_scan(original_text, nested_templates)
+    return existing_banners_info, zh_wpbs_span, nested_templates, canonical_names
+
+def apply_patches(text: str, patches: list[tuple[int, int, str]]) -> str:
+    """把 (起始, 结束, 替换文本) 补丁应用到原文上，补丁区间互不重叠"""
+    parts = []
+    pos = 0
+    for start, end, replacement in sorted(patches, key=lambda p: (p[0], p[1])):
+        parts.append(text[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+def format_zh_banners(templates_data: list[tuple[str, str | None]]) -> str:
+    """把 [(原始中文名, 英文评级)] 格式化为每行一个横幅模板的文本"""
+    formatted_templates_list = []
+    for raw_name, en_importance in templates_data:
+        # 只有当英文版有评级时，才在新模板中加入 importance 参数
+        if en_importance:
+            # 确保模板名和第一个参数之间有空格
+            formatted_templates_list.append(f"{{{{{raw_name} |importance={en_importance}}}}}")
+        else:
+            # 否则只加模板名
+            formatted_templates_list.append(f"{{{{{raw_name}}}}}")
+    return "\n".join(formatted_templates_list)
+
+def build_new_wpbs_text(target_zh_templates_map: dict[str, tuple[str | None, str]]) -> str:
+    """创建包含所有目标模板的新 WPBS 文本"""
+    all_templates_data = []
+    for canonical_name in sorted(list(target_zh_templates_map.keys())):
+         en_importance, raw_zh_name = target_zh_templates_map[canonical_name]
+         all_templates_data.append((raw_zh_name, en_importance))
+    return f"{{{{{default_zh_wpbs_name}|1=\n{format_zh_banners(all_templates_data)}\n}}}}"
+
+def build_zh_talk_text_patch(original_text: str, nested_templates: list[dict], zh_wpbs_span: dict | None,
+                             target_zh_templates_map: dict[str, tuple[str | None, str]],
+                             new_templates_data: list[tuple[str, str | None]],
+                             importance_updates: dict[str, str], canonical_names: dict[str, str]) -> str:
+    """
+    补丁引擎：计算最小字符区间补丁并直接应用到原文，不重新序列化整个页面。
+    - 在第一个 WPBS 的参数 1 末尾插入新横幅；
+    - 在 WPBS 内的横幅上设置或替换 importance= 参数；
+    - 没有 WPBS 时在页面顶部插入新的 WPBS。
+    canonical_names 为预先解析好的 {原始模板名: 规范名}，因此本函数不访问网络，可以在子进程中运行。
+    """
+    if not zh_wpbs_span:
+        new_wpbs_text = build_new_wpbs_text(target_zh_templates_map)
+        return f"{new_wpbs_text}\n{original_text}" if original_text.strip() else new_wpbs_text
+
+    patches = []
+    param1 = get_template_param(zh_wpbs_span, '1')
+    if importance_updates and param1:
+        for nested in nested_templates:
+            canonical_name = canonical_names.get(nested['name'])
+            if canonical_name not in importance_updates:
+                continue
+            new_importance = importance_updates[canonical_name]
+            importance_param = get_template_param(nested, 'importance')
+            if importance_param:
+                # 只替换参数值本身，保留其前后的空白
+                value = original_text[importance_param['value_start']:importance_param['value_end']]
+                value_start = importance_param['value_start'] + len(value) - len(value.lstrip())
+                value_end = importance_param['value_start'] + len(value.rstrip())
+                if value_end < value_start: value_end = value_start
+                patches.append((value_start, value_end, new_importance))
+            else:
+                patches.append((nested['name_end'], nested['name_end'], f"|importance={new_importance}"))
+
+    if new_templates_data:
+        new_templates_str = format_zh_banners(new_templates_data)
+        if param1:
+            value = original_text[param1['value_start']:param1['value_end']]
+            if value.strip(): # 在最后一个非空白字符之后追加，保留参数末尾原有的换行
+                insert_at = param1['value_start'] + len(value.rstrip())
+                patches.append((insert_at, insert_at, "\n" + new_templates_str))
+            else: # 参数 1 为空，直接设置
+                patches.append((param1['value_start'], param1['value_end'], "\n" + new_templates_str + "\n"))
+        else: # 参数 1 不存在，优先放在 class 参数之后
+            class_param = get_template_param(zh_wpbs_span, 'class')
+            insert_at = class_param['end'] if class_param else zh_wpbs_span['end'] - 2
+            patches.append((insert_at, insert_at, "|1=\n" + new_templates_str + "\n"))
+
+    return apply_patches(original_text, patches)
+
+def build_zh_talk_text_tree(wikicode: mwparserfromhell.wikicode.Wikicode, zh_wpbs_template_obj: mwparserfromhell.nodes.Template | None,
+                            target_zh_templates_map: dict[str, tuple[str | None, str]],
+                            new_templates_data: list[tuple[str, str | None]],
+                            importance_updates: dict[str, str]) -> str:
+    """树方式：修改 mwparserfromhell 语法树后重新序列化整个页面（原地修改 wikicode）"""
+    global error_other
+    if not zh_wpbs_template_obj: # 创建新的 WPBS
+        # 将新 WPBS 插入到讨论页顶部
+        wikicode.insert(0, build_new_wpbs_text(target_zh_templates_map) + "\n")
+        return str(wikicode).strip()
+
+    # 处理现有模板的重要性评级
+    if importance_updates and zh_wpbs_template_obj.has('1'):
+        # 确保我们操作的是 WPBS 参数 1 内的模板对象
+        param1_wikicode = zh_wpbs_template_obj.get('1').value # 这是 Wikicode 对象
+        # 遍历参数1内的模板进行修改
+        for nested_tpl in param1_wikicode.filter_templates():
+            nested_tpl_raw_name = str(nested_tpl.name).strip().replace('_', ' ')
+            canonical_name = get_canonical_zh_template_name(nested_tpl_raw_name)
+            if canonical_name not in importance_updates:
+                continue
+            try:
+                # 设置值时不加空格，依赖 mwparserfromhell 的默认格式
+                param_value = importance_updates[canonical_name]
+                if nested_tpl.has('importance'):
+                    # 更新现有参数
+                    nested_tpl.get('importance').value = param_value
+                elif nested_tpl.params:
+                    # 如果已有参数，插入到第一个参数之前
+                    nested_tpl.add('importance', param_value, before=nested_tpl.params[0].name)
+                else:
+                    # 如果没有参数，直接添加
+                    nested_tpl.add('importance', param_value) # mwparserfromhell 会在模板名和 | 之间加空格
+            except Exception as e:
+                pywikibot.error(f"!!! 更新模板 '{canonical_name}' 重要性时出错: {e}")
+                error_other += 1
+
+    # 如果有新模板要添加
+    if new_templates_data:
+        new_templates_str = format_zh_banners(new_templates_data)
+        try:
+            if zh_wpbs_template_obj.has('1'):
+                current_value_node = zh_wpbs_template_obj.get('1').value # 这是 Wikicode 对象
+                # 在现有内容的末尾（但在结束 }} 之前）添加新模板
+                if str(current_value_node).strip(): # 确保参数1内部有内容
+                     current_value_node.append("\n" + new_templates_str)
+                else: # 参数1为空，直接设置
+                     current_value_node.append(new_templates_str)
+            else: # 参数 1 不存在
+                param1_value = "\n" + new_templates_str + "\n"
+                added = False
+                if zh_wpbs_template_obj.has('class'):
+                     try:
+                         zh_wpbs_template_obj.add('1', param1_value, after='class')
+                         added = True
+                     except ValueError: pass
+                if not added:
+                     zh_wpbs_template_obj.add('1', param1_value)
+        except Exception as e:
+             pywikibot.error(f"!!! 添加新模板到现有 WPBS 时出错: {e}。")
+             error_other += 1
+             # 继续尝试保存，因为重要性可能已更新
+
+    return str(wikicode)
+
+def compare_with_tree(original_text: str, patched_text: str,
+                      target_zh_templates_map: dict[str, tuple[str | None, str]],
+                      new_templates_data: list[tuple[str, str | None]],
+                      importance_updates: dict[str, str]) -> tuple[str, bool]:
+    """
+    用树方式校验补丁结果：由原页面的语法树和编辑计划推算编辑后应有的横幅签名，与补丁结果的签名比对。
+    只在不一致时才用树方式重新生成文本。返回 (应使用的文本, 是否回退到了树方式结果)。
+    不输出日志，可以在子进程中运行。
+    """
+    existing_banners_info, zh_wpbs_template_obj, wikicode = get_existing_zh_banners(original_text)
+    wpbs_count = count_zh_wpbs(wikicode)
+    if zh_wpbs_template_obj:
+        importances = {name: importance for name, (importance, _) in existing_banners_info.items()}
+        importances.update(importance_updates)
+        added_templates_data = new_templates_data
+    else: # 树方式会在页面顶部创建包含全部目标模板的新 WPBS
+        wpbs_count += 1
+        importances = {}
+        added_templates_data = [(raw_zh_name, en_importance) for _, (en_importance, raw_zh_name)
+                                in sorted(target_zh_templates_map.items())]
+    for raw_zh_name, en_importance in added_templates_data:
+        canonical_name = get_canonical_zh_template_name(raw_zh_name)
+        if canonical_name:
+            importances[canonical_name] = en_importance or None
+    if get_banner_signature(patched_text) == (wpbs_count, sorted(importances.items())):
+        return patched_text, False
+    return build_zh_talk_text_tree(wikicode, zh_wpbs_template_obj, target_zh_templates_map,
+                                   new_templates_data, importance_updates), True
+
+def verify_patch_result(original_text: str, patched_text: str,
+                        target_zh_templates_map: dict[str, tuple[str | None, str]],
+                        new_templates_data: list[tuple[str, str | None]],
+                        importance_updates: dict[str, str]) -> str:
+    """用树方式校验补丁结果：一致时返回补丁结果，否则记录并回退到树方式的结果"""
+    global patch_engine_mismatches
+    verified_text, fell_back = compare_with_tree(original_text, patched_text, target_zh_templates_map,
+                                                 new_templates_data, importance_updates)
+    if fell_back:
+        vwarn("...补丁引擎结果与树方式结果不一致，改用树方式结果。")
+        patch_engine_mismatches += 1
+    return verified_text
+
+def get_banner_signature(text: str) -> tuple:
+    """用树方式解析文本，得到 (WPBS 数量, 第一个 WPBS 内的 {规范名: 重要度})，用于比对两种引擎的结果"""
+    existing_banners_info, _, wikicode = get_existing_zh_banners(text)
+    return count_zh_wpbs(wikicode), sorted((name, imp) for name, (imp, _) in existing_banners_info.items())
+
+def count_zh_wpbs(wikicode: mwparserfromhell.wikicode.Wikicode) -> int:
+    """统计语法树中 WPBS 模板的数量（包括嵌套的）"""
+    return sum(1 for tpl in wikicode.filter_templates()
+               if str(tpl.name).strip().replace('_', ' ').lower() in zh_wpbs_names_lower)
 
 # --- 主处理逻辑 ---
-def process_page(en_title: str):
-    """处理单个英文条目及其对应的中文条目"""
-    global skipped_no_zh_page, skipped_no_en_talk, skipped_en_talk_redirect, skipped_zh_talk_redirect
-    global skipped_no_relevant_en_banners, skipped_no_mapping, skipped_no_new_banners_or_importance_updates
-    global skipped_creation_no_banners, error_zh_save, error_other, edits_made
+def fetch_en_source(en_title: str) -> tuple[pywikibot.Page, pywikibot.Page, str] | None:
+    """
+    解析阶段的 I/O 部分：找到对应的中文页面，检查并获取英文讨论页文本。
+    返回 (中文页面对象, 英文讨论页对象, 英文讨论页文本)，无法处理时返回 None。
+    """
+    global skipped_no_en_talk, skipped_en_talk_redirect, error_other
+    global skipped_duplicate_pair
 
     # 1. 获取中文页面对象
     zh_page = get_zh_page_from_en_title(en_title)
-    if not zh_page: return
+    if not zh_page: return None
 
-    # 2. 获取英文讨论页并提取相关模板
-    en_page = pywikibot.Page(site_objects['en'], en_title)
+    # 2. 获取英文讨论页
+    en_page = pywikibot.Page(get_site('en'), en_title)
     en_talk_page = en_page.toggleTalkPage()
     try: # 检查英文讨论页状态
         if not en_talk_page.exists():
-             pywikibot.output(f"英文讨论页 '{en_talk_page.title()}' 不存在，跳过。")
+             if verbose_enabled: vlog(f"英文讨论页 '{en_talk_page.title()}' 不存在，跳过。")
              skipped_no_en_talk += 1
-             return
+             return None
         if en_talk_page.isRedirectPage():
-             pywikibot.warning(f"英文讨论页 '{en_talk_page.title()}' 是重定向页，跳过。")
+             if verbose_enabled: vwarn(f"英文讨论页 '{en_talk_page.title()}' 是重定向页，跳过。")
              skipped_en_talk_redirect += 1
-             return
+             return None
     except Exception as e:
+         raise_if_retryable(e, 'error_other')
          pywikibot.error(f"检查英文讨论页 '{en_talk_page.title()}' 状态时出错: {e}")
          error_other += 1
-         return # 无法确定状态，跳过
+         return None # 无法确定状态，跳过
+
+    # 多个列表中的不同标题可能指向同一对条目，每对只处理一次（同一标题的重试除外）
+    pair_key = (en_talk_page.title(), zh_page.title())
+    if processed_pairs.setdefault(pair_key, en_title) != en_title:
+        if verbose_enabled: vlog(f"条目对 '{en_talk_page.title()}' -> '{zh_page.title()}' 已在本次运行中处理过，跳过。")
+        skipped_duplicate_pair += 1
+        return None
+
+    en_talk_text = fetch_en_talk_text(en_talk_page)
+    if en_talk_text is None:
+        return None
+    return zh_page, en_talk_page, en_talk_text
+
+def map_en_templates(zh_page: pywikibot.Page, en_talk_page: pywikibot.Page,
+                     en_templates_with_importance: dict[str, str | None]) -> dict[str, tuple[str | None, str]] | None:
+    """
+    把英文讨论页上的专题模板映射为中文模板。
+    返回 {中文规范名: (英文评级, 原始中文名)}，没有可用映射时返回 None。
+    """
+    global skipped_no_relevant_en_banners, skipped_no_mapping
 
-    # 调用修改后的函数，获取英文模板及其重要度
-    en_templates_with_importance = extract_en_wikiproject_templates(en_talk_page)
     if not en_templates_with_importance:
-        pywikibot.output(f"未在英文讨论页 '{en_talk_page.title()}' 找到符合条件的专题模板，跳过。")
+        if verbose_enabled: vlog(f"未在英文讨论页 '{en_talk_page.title()}' 找到符合条件的专题模板，跳过。")
         skipped_no_relevant_en_banners += 1
-        return
-    pywikibot.output(f"从英文讨论页找到 {len(en_templates_with_importance)} 个相关模板及其评级:")
+        return None
+    if verbose_enabled: vlog(f"从英文讨论页 '{en_talk_page.title()}' 找到 {len(en_templates_with_importance)} 个相关模板及其评级:")
     # for name, imp in sorted(en_templates_with_importance.items()): # 日志过多
-    #     pywikibot.output(f"  - {name}: importance={imp}")
+    #     vlog(f"  - {name}: importance={imp}")
 
     # 3. 映射英文模板到中文模板，并传递重要度信息
     # target_zh_templates_map = {zh_canonical_name: (en_importance, en_raw_name)}
     target_zh_templates_map = {}
     failed_mappings = set()
+    if resolver_backend == 'langlinks': # 用一次查询取回本页所有未缓存模板的语言链接
+        uncached_names = {normalize_en_template_name(name) for name in en_templates_with_importance}
+        prefetch_langlinks([f"Template:{name}" for name in sorted(uncached_names) if name and not template_map_cache.has(name)])
     for en_name, en_importance in en_templates_with_importance.items():
         zh_name_raw = get_zh_template_name_from_en(en_name)
         if zh_name_raw:
@@ -610,196 +1913,184 @@ def process_page(en_title: str):
                    compare_importance(en_importance, target_zh_templates_map[canonical_zh_name][0]):
                     target_zh_templates_map[canonical_zh_name] = (en_importance, zh_name_raw) # 存储英文评级和原始中文名
             else:
-                pywikibot.warning(f"...映射得到的中文模板 '{zh_name_raw}' 无法获取规范名，忽略。")
+                vwarn(f"...映射得到的中文模板 '{zh_name_raw}' 无法获取规范名，忽略。")
                 failed_mappings.add(en_name)
         else:
             failed_mappings.add(en_name)
 
     if not target_zh_templates_map:
-        pywikibot.output(f"未能将任何英文模板成功映射到有效的中文模板，跳过页面 '{zh_page.title()}'。")
+        if verbose_enabled: vlog(f"未能将任何英文模板成功映射到有效的中文模板，跳过页面 '{zh_page.title()}'。")
         skipped_no_mapping += 1
-        return
-    pywikibot.output(f"成功映射得到 {len(target_zh_templates_map)} 个目标中文模板(规范名)及其对应的英文评级:")
+        return None
+    vlog(f"成功映射得到 {len(target_zh_templates_map)} 个目标中文模板(规范名)及其对应的英文评级:")
     # for name, (imp, _) in sorted(target_zh_templates_map.items()): # 日志过多
-    #     pywikibot.output(f"  - {name}: en_importance={imp}")
-    if failed_mappings: pywikibot.output(f"(注意: {len(failed_mappings)} 个英文模板未能映射或映射无效: {', '.join(sorted(list(failed_mappings)))})")
+    #     vlog(f"  - {name}: en_importance={imp}")
+    if failed_mappings and verbose_enabled: vlog(f"(注意: {len(failed_mappings)} 个英文模板未能映射或映射无效: {', '.join(sorted(list(failed_mappings)))})")
+
+    return target_zh_templates_map
+
+def merge_target_maps(merged_map: dict[str, tuple[str | None, str]], target_map: dict[str, tuple[str | None, str]]) -> None:
+    """
+    把另一个英文来源的目标模板映射合并到 merged_map 中（原地修改）。
+    与单页映射相同：同一个中文模板对应多个英文来源时，保留评级更高的英文评级。
+    """
+    for canonical_zh_name, (en_importance, raw_zh_name) in target_map.items():
+        if canonical_zh_name not in merged_map or \
+           compare_importance(en_importance, merged_map[canonical_zh_name][0]):
+            merged_map[canonical_zh_name] = (en_importance, raw_zh_name)
 
+def fetch_zh_target(zh_page: pywikibot.Page) -> tuple[pywikibot.Page, str] | None:
+    """编辑阶段的 I/O 部分：检查并获取中文讨论页。返回 (中文讨论页对象, 页面文本)，无法处理时返回 None"""
+    global skipped_zh_talk_redirect, error_other
 
-    # 4. 获取中文讨论页及现有横幅信息 (包括重要度和模板对象)
+    # 4. 获取中文讨论页
     zh_talk_page = zh_page.toggleTalkPage()
     try: # 检查中文讨论页是否是重定向
         if zh_talk_page.exists() and zh_talk_page.isRedirectPage():
-             pywikibot.warning(f"中文讨论页 '{zh_talk_page.title()}' 是重定向页，跳过编辑。")
+             if verbose_enabled: vwarn(f"中文讨论页 '{zh_talk_page.title()}' 是重定向页，跳过编辑。")
              skipped_zh_talk_redirect += 1
-             return
+             return None
     except Exception as e:
+        raise_if_retryable(e, 'error_other')
         pywikibot.error(f"检查中文讨论页 '{zh_talk_page.title()}' 状态时出错: {e}")
         error_other += 1
-        return
-
-    # 调用修改后的函数，获取现有横幅信息和 wikicode 对象
-    existing_zh_banners_info, zh_wpbs_template_obj, original_zh_talk_text, wikicode = get_existing_zh_banners(zh_talk_page)
-    page_exists = wikicode is not None # 如果 wikicode 不是 None，说明页面存在且已解析
+        return None
 
-    # --- 步骤 5 & 6: 处理模板添加和重要度更新 ---
-    importance_updated = False
-    templates_added = False
+    original_zh_talk_text = fetch_zh_talk_text(zh_talk_page)
+    if original_zh_talk_text is None:
+        return None # 获取失败时不要把页面当作不存在而覆盖
+    return zh_talk_page, original_zh_talk_text
 
-    if not wikicode: # 如果页面不存在，创建一个空的 wikicode 对象
-        wikicode = mwparserfromhell.parse("")
-        original_zh_talk_text = "" # 确保比较时是空字符串
+def plan_zh_changes(target_zh_templates_map: dict[str, tuple[str | None, str]],
+                    existing_zh_banners_info: dict[str, tuple[str | None, object]],
+                    has_wpbs: bool, page_exists: bool) -> tuple[list[tuple[str, str | None]], dict[str, str]]:
+    """
+    步骤 5 & 6：确定需要添加的新模板和需要更新的重要度。
+    返回 ([(原始中文名, 英文评级)], {中文规范名: 新重要度})。
+    """
+    if verbose_enabled: # 安静模式下不为日志排序、拼接名称
+        if has_wpbs:
+            existing_names = sorted(existing_zh_banners_info.keys())
+            vlog(f"...已存在于第一个 WPBS 内的规范化专题模板 ({len(existing_names)}): {', '.join(existing_names)}")
+        elif page_exists:
+            vlog("...未在页面上找到 WPBS 模板。")
 
     # 确定需要添加的新模板 (规范名)
     new_canonical_templates_to_add = set(target_zh_templates_map.keys()) - set(existing_zh_banners_info.keys())
     new_templates_data = [] # 存储 (原始名称, 英文评级)
     if new_canonical_templates_to_add:
-        templates_added = True
-        pywikibot.output(f"需要添加 {len(new_canonical_templates_to_add)} 个新模板(规范名): {', '.join(sorted(list(new_canonical_templates_to_add)))}")
+        if verbose_enabled: vlog(f"需要添加 {len(new_canonical_templates_to_add)} 个新模板(规范名): {', '.join(sorted(list(new_canonical_templates_to_add)))}")
         for canonical_name in sorted(list(new_canonical_templates_to_add)):
             en_importance, raw_zh_name = target_zh_templates_map[canonical_name]
             new_templates_data.append((raw_zh_name, en_importance)) # 使用映射时的原始中文名添加
 
     # 处理现有模板的重要性评级
-    if zh_wpbs_template_obj and existing_zh_banners_info:
-        pywikibot.output("检查现有中文模板的重要性评级...")
-        # 确保我们操作的是 WPBS 参数 1 内的模板对象
-        if zh_wpbs_template_obj.has('1'):
-            param1_node = zh_wpbs_template_obj.get('1')
-            param1_wikicode = param1_node.value # 这是 Wikicode 对象
-            # 遍历参数1内的模板进行修改
-            for nested_tpl in param1_wikicode.filter_templates():
-                nested_tpl_raw_name = str(nested_tpl.name).strip().replace('_', ' ')
-                canonical_name = get_canonical_zh_template_name(nested_tpl_raw_name)
-
-                if canonical_name and canonical_name in existing_zh_banners_info:
-                    current_zh_importance, _ = existing_zh_banners_info[canonical_name] # 从解析结果获取当前评级
-                    target_en_importance, _ = target_zh_templates_map.get(canonical_name, (None, None)) # 获取对应的英文评级
-
-                    new_importance = None
-                    update_reason = ""
-
-                    # 规则：仅当英文有评级且严格高于中文评级时才更新
-                    if target_en_importance is not None and compare_importance(target_en_importance, current_zh_importance):
-                        new_importance = target_en_importance
-                        update_reason = f"英文评级 '{target_en_importance}' 高于中文评级 '{current_zh_importance}'"
-                    # 其他情况（英文无评级、英文评级不高、中文无评级）均不更新或添加
-
-                    if new_importance:
-                        try:
-                            # 设置值时不加空格，依赖 mwparserfromhell 的默认格式
-                            param_value = new_importance
-                            if nested_tpl.has('importance'):
-                                # 更新现有参数
-                                nested_tpl.get('importance').value = param_value
-                            else:
-                                # 添加为第一个参数
-                                if nested_tpl.params:
-                                    # 如果已有参数，插入到第一个参数之前
-                                    first_param_name = nested_tpl.params[0].name
-                                    # 使用 mwparserfromhell 的 add 方法，它通常会处理好空格
-                                    nested_tpl.add('importance', param_value, before=first_param_name)
-                                else:
-                                    # 如果没有参数，直接添加
-                                    nested_tpl.add('importance', param_value) # mwparserfromhell 会在模板名和 | 之间加空格
-
-                            pywikibot.output(f"...更新模板 '{canonical_name}': {update_reason}")
-                            importance_updated = True
-                        except Exception as e:
-                            pywikibot.error(f"!!! 更新模板 '{canonical_name}' 重要性时出错: {e}")
-                            error_other += 1
-        else:
-             pywikibot.warning("...现有 WPBS 没有参数 '1'，无法检查内部模板的重要性。")
+    # importance_updates = {zh_canonical_name: new_importance}
+    importance_updates = {}
+    if has_wpbs and existing_zh_banners_info:
+        vlog("检查现有中文模板的重要性评级...")
+        for canonical_name, (current_zh_importance, _) in existing_zh_banners_info.items():
+            target_en_importance, _ = target_zh_templates_map.get(canonical_name, (None, None)) # 获取对应的英文评级
+            # 规则：仅当英文有评级且严格高于中文评级时才更新
+            # 其他情况（英文无评级、英文评级不高、中文无评级）均不更新或添加
+            if target_en_importance is not None and compare_importance(target_en_importance, current_zh_importance):
+                importance_updates[canonical_name] = target_en_importance
+                vlog(f"...更新模板 '{canonical_name}': 英文评级 '{target_en_importance}' 高于中文评级 '{current_zh_importance}'")
+
+    if not has_wpbs and (new_templates_data or importance_updates):
+        vlog("未检测到现有 WPBS，将创建新的 WPBS...")
+    annotate_record(added_banners=[raw_name for raw_name, _ in new_templates_data],
+                    importance_changes={name: [existing_zh_banners_info[name][0], new_importance]
+                                        for name, new_importance in importance_updates.items()},
+                    created_wpbs=not has_wpbs)
+    return new_templates_data, importance_updates
+
+def build_zh_edit(original_text: str, nested_templates: list[dict], zh_wpbs_span: dict | None,
+                  target_zh_templates_map: dict[str, tuple[str | None, str]],
+                  new_templates_data: list[tuple[str, str | None]],
+                  importance_updates: dict[str, str], canonical_names: dict[str, str | None],
+                  want_diff: bool = True, verify: bool = False) -> tuple[str, str | None, bool]:
+    """
+    在子进程中运行的编辑计算：用补丁引擎生成新文本，并生成只含改动行的 unified diff。
+    verify 为 True 时同时用树方式校验；所需的规范名已在主进程中解析（canonical_names 和目标映射），
+    预先填入子进程的重定向缓存，其余名称在子进程中只做规范化（见 init_worker_process），因此校验不访问网络。
+    返回 (新文本, diff 文本, 是否回退到了树方式结果)；want_diff 为 False 时不计算 diff。
+    """
+    new_text = build_zh_talk_text_patch(original_text, nested_templates, zh_wpbs_span, target_zh_templates_map,
+                                        new_templates_data, importance_updates, canonical_names)
+    fell_back = False
+    if verify:
+        zh_template_redirect_cache.update(canonical_names)
+        for canonical_name, (_, raw_zh_name) in target_zh_templates_map.items():
+            zh_template_redirect_cache[raw_zh_name.strip().replace('_', ' ')] = canonical_name
+            zh_template_redirect_cache[canonical_name] = canonical_name
+        verified_text, fell_back = compare_with_tree(original_text, new_text, target_zh_templates_map,
+                                                     new_templates_data, importance_updates)
+        new_text = verified_text
+    if not want_diff:
+        return new_text, None, fell_back
+    diff_lines = difflib.unified_diff(original_text.splitlines(), new_text.splitlines(), lineterm='', n=0)
+    diff_text = '\n'.join(list(diff_lines)[2:]) # 去掉 ---/+++ 文件头
+    return new_text, diff_text, fell_back
+
+def process_page(zh_page: pywikibot.Page, target_zh_templates_map: dict[str, tuple[str | None, str]]):
+    """
+    编辑阶段：根据（已合并所有英文来源的）目标模板映射更新中文讨论页。
+    每个中文讨论页在一次运行中只调用一次。
+    """
+    global skipped_no_new_banners_or_importance_updates, error_other
+
+    fetched = fetch_zh_target(zh_page)
+    if not fetched:
+        return
+    zh_talk_page, original_zh_talk_text = fetched
+    page_exists = bool(original_zh_talk_text)
 
+    # 按所选引擎解析现有横幅信息
+    try:
+        if edit_engine == 'patch':
+            existing_zh_banners_info, zh_wpbs_span, zh_nested_templates, zh_canonical_names = scan_existing_zh_banners(original_zh_talk_text)
+            has_wpbs = zh_wpbs_span is not None
+        else:
+            existing_zh_banners_info, zh_wpbs_template_obj, wikicode = get_existing_zh_banners(original_zh_talk_text)
+            has_wpbs = zh_wpbs_template_obj is not None
+    except Exception as e:
+        raise_if_retryable(e, 'error_other') # 规范名查询可能遇到暂时性错误
+        pywikibot.error(f"...解析中文讨论页 '{zh_talk_page.title()}' 时发生未知错误: {e}")
+        error_other += 1
+        import traceback; traceback.print_exc()
+        return
 
+    # --- 步骤 5 & 6: 确定模板添加和重要度更新 ---
+    new_templates_data, importance_updates = plan_zh_changes(target_zh_templates_map, existing_zh_banners_info,
+                                                             has_wpbs, page_exists)
     # 如果没有新模板添加，也没有重要度更新，则跳过
-    if not templates_added and not importance_updated:
-        pywikibot.output("无需添加新模板，且现有模板重要性无需更新。跳过页面。")
+    if not new_templates_data and not importance_updates:
+        vlog("无需添加新模板，且现有模板重要性无需更新。跳过页面。")
         skipped_no_new_banners_or_importance_updates += 1
         return
 
     # --- 构建新文本 ---
-    # (如果需要添加新模板)
-    formatted_new_templates_list = []
-    if templates_added:
-        for raw_name, en_importance in new_templates_data:
-            # 只有当英文版有评级时，才在新模板中加入 importance 参数
-            if en_importance:
-                # 确保模板名和第一个参数之间有空格
-                formatted_new_templates_list.append(f"{{{{{raw_name} |importance={en_importance}}}}}")
-            else:
-                # 否则只加模板名
-                formatted_new_templates_list.append(f"{{{{{raw_name}}}}}")
-
-    if zh_wpbs_template_obj: # 合并到现有 WPBS
-        pywikibot.output("处理现有 WPBS...")
-        target_wpbs = zh_wpbs_template_obj
-
-        # 如果有新模板要添加
-        if templates_added:
-            pywikibot.output("...将新模板添加到参数 1...")
-            new_templates_str = "\n".join(formatted_new_templates_list)
-            try:
-                if target_wpbs.has('1'):
-                    param1 = target_wpbs.get('1')
-                    current_value_node = param1.value # 这是 Wikicode 对象
-                    # 在现有内容的末尾（但在结束 }} 之前）添加新模板
-                    # 为了保持格式，最好在最后一个现有模板后加换行再加新模板
-                    current_value_str = str(current_value_node).strip()
-                    if current_value_str: # 确保参数1内部有内容
-                         # 在现有内容后加换行符和新模板字符串
-                         current_value_node.append("\n" + new_templates_str)
-                    else: # 参数1为空，直接设置
-                         current_value_node.strip() # 清空可能存在的空白
-                         current_value_node.append(new_templates_str)
-
-                    # 确保参数值前后有换行符（可选，看风格）
-                    # param1.value = "\n" + str(current_value_node).strip() + "\n"
-                    pywikibot.output("...已将新模板追加到现有参数 1。")
-                else: # 参数 1 不存在
-                    param1_value = "\n" + new_templates_str + "\n"
-                    added = False
-                    if target_wpbs.has('class'):
-                         try:
-                             target_wpbs.add('1', param1_value, after='class')
-                             added = True
-                         except ValueError: pass
-                    if not added:
-                         target_wpbs.add('1', param1_value)
-                    pywikibot.output("...参数 1 不存在，已创建并添加新模板。")
-            except Exception as e:
-                 pywikibot.error(f"!!! 添加新模板到现有 WPBS 时出错: {e}。")
-                 error_other += 1
-                 # 继续尝试保存，因为重要性可能已更新
-
-        # 重要性更新已在上面通过修改 nested_tpl 完成，这里无需额外操作
-        # 只需获取最终文本
-        new_zh_talk_text = str(wikicode)
-
-    else: # 创建新的 WPBS
-        pywikibot.output("未检测到现有 WPBS，将创建新的 WPBS...")
-        # 包含所有目标模板（包括原本就该有的，现在作为“新”模板添加）
-        all_templates_data = []
-        for canonical_name in sorted(list(target_zh_templates_map.keys())):
-             en_importance, raw_zh_name = target_zh_templates_map[canonical_name]
-             all_templates_data.append((raw_zh_name, en_importance))
-
-        formatted_all_templates_list = []
-        for raw_name, en_importance in all_templates_data:
-            # 只有当英文版有评级时，才在新模板中加入 importance 参数
-            if en_importance:
-                # 确保模板名和第一个参数之间有空格
-                formatted_all_templates_list.append(f"{{{{{raw_name} |importance={en_importance}}}}}")
-            else:
-                 # 否则只加模板名
-                formatted_all_templates_list.append(f"{{{{{raw_name}}}}}")
-
-        templates_for_new_wpbs = "\n".join(formatted_all_templates_list)
-        new_wpbs_text = f"{{{{{default_zh_wpbs_name}|1=\n{templates_for_new_wpbs}\n}}}}"
+    if edit_engine == 'patch':
+        new_zh_talk_text = build_zh_talk_text_patch(original_zh_talk_text, zh_nested_templates, zh_wpbs_span,
+                                                    target_zh_templates_map, new_templates_data, importance_updates,
+                                                    zh_canonical_names)
+        if verify_edit_engine:
+            new_zh_talk_text = verify_patch_result(original_zh_talk_text, new_zh_talk_text, target_zh_templates_map,
+                                                   new_templates_data, importance_updates)
+    else:
+        new_zh_talk_text = build_zh_talk_text_tree(wikicode, zh_wpbs_template_obj, target_zh_templates_map,
+                                                   new_templates_data, importance_updates)
 
-        # 将新 WPBS 插入到讨论页顶部
-        wikicode.insert(0, new_wpbs_text + "\n")
+    save_zh_talk_page(zh_talk_page, original_zh_talk_text, new_zh_talk_text, page_exists,
+                      new_templates_data, bool(importance_updates))
 
-        new_zh_talk_text = str(wikicode).strip()
+def save_zh_talk_page(zh_talk_page: pywikibot.Page, original_zh_talk_text: str, new_zh_talk_text: str,
+                      page_exists: bool, new_templates_data: list[tuple[str, str | None]],
+                      importance_updated: bool, diff_text: str | None = None):
+    """步骤 7：显示差异并保存中文讨论页。diff_text 为已在子进程中算好的差异，缺省时用 showDiff 现场计算（仅详细日志模式）"""
+    global error_zh_save, edits_made
+    templates_added = bool(new_templates_data)
 
     # --- 步骤 7: 保存页面 ---
     # 只有当文本确实发生改变时才保存
@@ -818,9 +2109,14 @@ def process_page(en_title: str):
             # 使用分号分隔不同的操作类型
             final_summary += f"：{'; '.join(summary_actions)}"
 
-        pywikibot.output("页面内容将发生变化:")
-        pywikibot.showDiff(original_zh_talk_text, new_zh_talk_text)
-        pywikibot.output(f"编辑摘要: {final_summary}") # 显示最终摘要
+        annotate_record(summary=final_summary)
+        if verbose_enabled: # 差异计算开销较大，只在输出详细日志时进行
+            pywikibot.output("页面内容将发生变化:")
+            if diff_text is not None:
+                pywikibot.output(diff_text)
+            else:
+                pywikibot.showDiff(original_zh_talk_text, new_zh_talk_text)
+            pywikibot.output(f"编辑摘要: {final_summary}") # 显示最终摘要
 
         if not dry_run:
             try:
@@ -829,114 +2125,498 @@ def process_page(en_title: str):
                 # 使用动态生成的摘要
                 zh_talk_page.save(summary=final_summary, botflag=use_bot_flag)
                 edits_made += 1
-                pywikibot.output("页面已成功保存。")
+                vlog("页面已成功保存。")
             except LockedPageError:
                 pywikibot.error(f"!!! 页面 '{zh_talk_page.title()}' 被锁定，无法保存。")
                 error_zh_save += 1
             except OtherPageSaveError as e:
+                 raise_if_retryable(e, 'error_zh_save')
                  pywikibot.error(f"!!! 保存页面 '{zh_talk_page.title()}' 时发生 OtherPageSaveError: {e}")
                  error_zh_save += 1
             except APIError as e:
+                raise_if_retryable(e, 'error_zh_save') # 重试时会重新获取页面并重新计算编辑
                 pywikibot.error(f"!!! 保存页面 '{zh_talk_page.title()}' 时发生 API 错误: {e}")
                 error_zh_save += 1
-                if "ratelimited" in str(e).lower():
-                     pywikibot.warning("...触发速率限制，暂停 30 秒...")
-                     time.sleep(30)
             except Exception as e:
+                raise_if_retryable(e, 'error_zh_save')
                 pywikibot.error(f"!!! 保存页面 '{zh_talk_page.title()}' 时发生未知错误: {e}")
                 error_zh_save += 1
                 import traceback; traceback.print_exc()
         else:
-            pywikibot.output("Dry run 模式: 跳过保存。")
+            vlog("Dry run 模式: 跳过保存。")
+            annotate_record(outcome='dry_run')
     else:
+        annotate_record(outcome='unchanged')
         # 检查为何文本未变
         if not page_exists and not new_zh_talk_text.strip(): # 页面原不存在且最终也为空
-            pywikibot.output("页面不存在且最终无内容，跳过创建。")
+            vlog("页面不存在且最终无内容，跳过创建。")
             # skipped_creation_no_banners 计数器在前面已处理
         else:
-             pywikibot.output("页面内容无变化（可能因已完成或处理错误），跳过保存。")
-             # 如果 new_zh_templates_to_add_raw 不为空但文本没变，说明修改过程有问题
-             if new_zh_templates_to_add_raw:
+             vlog("页面内容无变化（可能因已完成或处理错误），跳过保存。")
+             # 如果需要添加新模板但文本没变，说明修改过程有问题
+             if templates_added:
                  pywikibot.warning("...检测到需要添加新模板，但最终页面文本未改变，请检查修改逻辑或showDiff输出。")
              # skipped_no_new_banners 计数器在前面已处理
 
+# --- 运行阶段 ---
+def add_resolved_page(pending_zh_pages: dict, en_title: str, zh_page: pywikibot.Page,
+                      target_zh_templates_map: dict[str, tuple[str | None, str]]):
+    """把解析结果按中文讨论页分组，指向同一页面的英文来源合并为一次编辑"""
+    global merged_en_sources
+    group_key = zh_page.toggleTalkPage().title()
+    if group_key in pending_zh_pages:
+        _, merged_map, en_sources = pending_zh_pages[group_key]
+        merge_target_maps(merged_map, target_zh_templates_map)
+        en_sources.append(en_title)
+        merged_en_sources += 1
+        vlog(f"...中文讨论页 '{group_key}' 已有其他英文来源，合并到同一次编辑 (共 {len(en_sources)} 个来源)。")
+    else:
+        pending_zh_pages[group_key] = (zh_page, dict(target_zh_templates_map), [en_title])
+
+def parse_en_source(en_talk_page: pywikibot.Page, en_talk_text: str) -> dict[str, str | None]:
+    """在主进程中解析英文讨论页，出错时返回空字典"""
+    global error_other
+    try:
+        return parse_en_wikiproject_templates(en_talk_text)
+    except Exception as e:
+        pywikibot.error(f"...解析英文讨论页 '{en_talk_page.title()}' 时发生未知错误: {e}")
+        error_other += 1
+        import traceback; traceback.print_exc()
+        return {}
+
+def log_progress(done: int, total: int, label: str):
+    """输出进度行：详细模式下每个单元一行，安静模式下每 progress_interval 个单元一行"""
+    if verbose_enabled:
+        pywikibot.output(f"\n--- [{done}/{total}] {label} ---")
+    elif done % progress_interval == 0 or done == total:
+        pywikibot.output(f"进度: [{done}/{total}] 已编辑 {edits_made}，错误 "
+                         f"{sum(globals()[name] for name in OUTCOME_COUNTERS if name.startswith('error_'))}")
+
+def resolve_titles(en_titles: list[str], pending_zh_pages: dict, executor: ProcessPoolExecutor | None = None):
+    """
+    解析阶段：逐个标题找到中文页面和目标模板，并按中文讨论页分组合并。
+    提供进程池时，英文讨论页的解析在子进程中进行，主进程继续获取后续页面。
+    遇到暂时性错误的标题进入重试队列，到期后在本阶段内重新处理。
+    """
+    global processed_counter, error_other
+    total_titles = len(en_titles)
+    set_run_stage('resolve', total_titles)
+    # window 中每项为 (日志记录, 英文标题, 中文页面对象, 英文讨论页对象, 解析任务 Future)
+    window = deque()
+    max_pending = process_workers * 4
+
+    def complete(record, en_title, zh_page, en_talk_page, en_templates_with_importance):
+        target_zh_templates_map = run_tracked(record, 'map', map_en_templates, zh_page, en_talk_page,
+                                              en_templates_with_importance)
+        if target_zh_templates_map:
+            record['zh_talk_title'] = zh_page.toggleTalkPage().title()
+            record['zh_templates'] = sorted(target_zh_templates_map)
+            add_resolved_page(pending_zh_pages, en_title, zh_page, target_zh_templates_map)
+        finish_record(record, 'resolved')
+
+    def finish_oldest():
+        global error_other, verbose_enabled
+        record, en_title, zh_page, en_talk_page, future = window.popleft()
+        verbose_enabled = record.pop('_verbose')
+        try:
+            try:
+                en_templates_with_importance, record['timings_ms']['parse'] = future.result()
+            except Exception as e:
+                pywikibot.error(f"...解析英文讨论页 '{en_talk_page.title()}' 时发生未知错误: {e}")
+                error_other += 1
+                record['counters']['error_other'] = record['counters'].get('error_other', 0) + 1
+                en_templates_with_importance = {}
+            complete(record, en_title, zh_page, en_talk_page, en_templates_with_importance)
+        except RetryableError as e: # 映射查询遇到暂时性错误
+            schedule_retry('resolve', en_title, e, record['attempt'], record)
+            finish_record(record, 'retry')
+        except Exception as e:
+            pywikibot.error(f"!!! 在解析 '{en_title}' 时发生顶层未知错误: {e}")
+            error_other += 1
+            record['counters']['error_other'] = record['counters'].get('error_other', 0) + 1
+            import traceback; traceback.print_exc()
+            finish_record(record, 'error')
+
+    def start(en_title, attempt):
+        global error_other
+        record = new_record('resolve', en_title=en_title, attempt=attempt)
+        try:
+            fetched = run_tracked(record, 'fetch', fetch_en_source, en_title)
+            if not fetched:
+                finish_record(record, 'skipped')
+            elif executor is None:
+                zh_page, en_talk_page, en_talk_text = fetched
+                en_templates_with_importance = run_tracked(record, 'parse', parse_en_source, en_talk_page, en_talk_text)
+                complete(record, en_title, zh_page, en_talk_page, en_templates_with_importance)
+            else:
+                zh_page, en_talk_page, en_talk_text = fetched
+                record['_verbose'] = verbose_enabled # 完成时恢复该标题的日志开关
+                future = executor.submit(timed_call, parse_en_wikiproject_templates, en_talk_text)
+                window.append((record, en_title, zh_page, en_talk_page, future))
+            while len(window) > max_pending:
+                finish_oldest()
+        except RetryableError as e:
+            schedule_retry('resolve', en_title, e, attempt, record)
+            finish_record(record, 'retry')
+        except Exception as e: # 捕获处理过程中未处理的意外错误
+             pywikibot.error(f"!!! 在解析 '{en_title}' 时发生顶层未知错误: {e}")
+             error_other += 1
+             record['counters']['error_other'] = record['counters'].get('error_other', 0) + 1
+             import traceback; traceback.print_exc()
+             finish_record(record, 'error')
+
+    def start_due_retries(wait=False):
+        for en_title, attempt in pop_due_retries('resolve', wait):
+            begin_log_unit()
+            vlog(f"\n--- [重试 {attempt}/{max_retry_attempts}] 解析英文条目: {en_title} ---")
+            start(en_title, attempt)
+
+    for i, en_title in enumerate(en_titles):
+        processed_counter = i + 1
+        if resolver_backend == 'langlinks' and i % LANGLINKS_BATCH_SIZE == 0:
+            prefetch_langlinks(en_titles[i:i + LANGLINKS_BATCH_SIZE])
+        begin_log_unit()
+        log_progress(processed_counter, total_titles, f"解析英文条目: {en_title}")
+        start(en_title, 1)
+        start_due_retries()
+        # 可选：每处理 N 个页面保存一次缓存
+        if processed_counter % 50 == 0:
+            save_cache(template_map_cache)
+    while window or retry_queues['resolve']:
+        while window:
+            finish_oldest()
+        start_due_retries(wait=True)
+
+def edit_zh_pages(pending_zh_pages: dict, executor: ProcessPoolExecutor | None = None):
+    """
+    编辑阶段：每个中文讨论页只处理并保存一次。
+    提供进程池时，模板扫描和新文本/差异的计算（以及引擎校验）在子进程中进行，主进程只负责 I/O。
+    遇到暂时性错误的页面进入重试队列，重试时重新获取页面并重新计算编辑。
+    """
+    global error_other
+    total_zh_pages = len(pending_zh_pages)
+    # scan_window 中每项为 (日志记录, 中文讨论页标题, 合并后的目标模板映射, 中文讨论页对象, 原文, 扫描任务 Future)
+    # build_window 中每项为 (日志记录, 中文讨论页标题, 中文讨论页对象, 原文, 新模板数据, 重要度更新, 编辑计算任务 Future)
+    scan_window = deque()
+    build_window = deque()
+    max_pending = process_workers * 4
+    set_run_stage('edit', total_zh_pages, build_window)
+
+    def plan_from_scan(original_text, merged_map, scan_result):
+        zh_wpbs_span, nested_templates = scan_result
+        existing_zh_banners_info, canonical_names = get_existing_zh_banners_from_scan(original_text, nested_templates)
+        new_templates_data, importance_updates = plan_zh_changes(merged_map, existing_zh_banners_info,
+                                                                 zh_wpbs_span is not None, bool(original_text))
+        return new_templates_data, importance_updates, canonical_names
+
+    def handle_error(record, group_key, error):
+        global error_other
+        if isinstance(error, RetryableError):
+            schedule_retry('edit', group_key, error, record['attempt'], record)
+            return
+        pywikibot.error(f"!!! 在处理 '{group_key}' 时发生顶层未知错误: {error}")
+        error_other += 1
+        record['counters']['error_other'] = record['counters'].get('error_other', 0) + 1
+        import traceback; traceback.print_exc()
+
+    def finish_oldest_scan():
+        global skipped_no_new_banners_or_importance_updates, verbose_enabled
+        record, group_key, merged_map, zh_talk_page, original_text, future = scan_window.popleft()
+        verbose_enabled = record.pop('_verbose')
+        try:
+            scan_result, record['timings_ms']['scan'] = future.result()
+            new_templates_data, importance_updates, canonical_names = run_tracked(
+                record, 'plan', plan_from_scan, original_text, merged_map, scan_result)
+            if not new_templates_data and not importance_updates:
+                vlog(f"'{group_key}' 无需添加新模板，且现有模板重要性无需更新。跳过页面。")
+                skipped_no_new_banners_or_importance_updates += 1
+                record['counters']['skipped_no_new_banners_or_importance_updates'] = 1
+            else:
+                zh_wpbs_span, nested_templates = scan_result
+                record['_verbose'] = verbose_enabled
+                future = executor.submit(timed_call, build_zh_edit, original_text, nested_templates, zh_wpbs_span,
+                                         merged_map, new_templates_data, importance_updates, canonical_names,
+                                         verbose_enabled, verify_edit_engine)
+                build_window.append((record, group_key, zh_talk_page, original_text,
+                                     new_templates_data, importance_updates, future))
+                return # 编辑计算完成后再结束该记录
+        except Exception as e:
+            handle_error(record, group_key, e)
+        finish_record(record, 'processed')
+
+    def finish_oldest_build():
+        global patch_engine_mismatches, verbose_enabled
+        record, group_key, zh_talk_page, original_text, new_templates_data, importance_updates, future = build_window.popleft()
+        verbose_enabled = record.pop('_verbose')
+        try:
+            (new_text, diff_text, fell_back), record['timings_ms']['build'] = future.result()
+            if fell_back:
+                vwarn("...补丁引擎结果与树方式结果不一致，改用树方式结果。")
+                patch_engine_mismatches += 1
+            run_tracked(record, 'save', save_zh_talk_page, zh_talk_page, original_text, new_text,
+                        bool(original_text), new_templates_data, bool(importance_updates), diff_text)
+        except Exception as e:
+            handle_error(record, group_key, e)
+        finish_record(record, 'processed')
+
+    def drain(limit):
+        while len(scan_window) > limit:
+            finish_oldest_scan()
+        while len(build_window) > limit:
+            finish_oldest_build()
+
+    def start(group_key, attempt):
+        global error_other
+        zh_page, merged_map, en_sources = pending_zh_pages[group_key]
+        record = new_record('edit', zh_talk_title=group_key, en_sources=en_sources, attempt=attempt)
+        try:
+            if executor is None:
+                run_tracked(record, 'process', process_page, zh_page, merged_map)
+                finish_record(record, 'processed')
+                # 可选：添加短暂延时以降低API请求频率
+                # time.sleep(0.5)
+            else:
+                fetched = run_tracked(record, 'fetch', fetch_zh_target, zh_page)
+                if fetched:
+                    zh_talk_page, original_text = fetched
+                    record['_verbose'] = verbose_enabled
+                    future = executor.submit(timed_call, scan_zh_wpbs, original_text)
+                    scan_window.append((record, group_key, merged_map, zh_talk_page, original_text, future))
+                else:
+                    finish_record(record, 'skipped')
+            drain(max_pending)
+        except RetryableError as e:
+            schedule_retry('edit', group_key, e, attempt, record)
+            finish_record(record, 'retry')
+        except Exception as e: # 捕获 process_page 内部未处理的意外错误
+             pywikibot.error(f"!!! 在处理 '{group_key}' 时发生顶层未知错误: {e}")
+             error_other += 1
+             record['counters']['error_other'] = record['counters'].get('error_other', 0) + 1
+             import traceback; traceback.print_exc()
+             finish_record(record, 'error')
+
+    def start_due_retries(wait=False):
+        for group_key, attempt in pop_due_retries('edit', wait):
+            begin_log_unit()
+            vlog(f"\n--- [重试 {attempt}/{max_retry_attempts}] 处理中文讨论页: {group_key} ---")
+            start(group_key, attempt)
+
+    for j, (group_key, (_, _, en_sources)) in enumerate(pending_zh_pages.items()):
+        begin_log_unit()
+        log_progress(j + 1, total_zh_pages, f"处理中文讨论页: {group_key} (来源: {', '.join(en_sources)})")
+        start(group_key, 1)
+        start_due_retries()
+    while scan_window or build_window or retry_queues['edit']:
+        drain(0)
+        start_due_retries(wait=True)
+
+# --- 输入列表 ---
+def normalize_en_title(en_title: str) -> str:
+    """规范化英文条目标题（下划线转空格、合并空格、首字母大写），用于跨列表去重"""
+    title = re.sub(r'[_ ]+', ' ', en_title).strip()
+    return title[:1].upper() + title[1:]
+
+def load_titles_from_file(filename: str) -> list[str] | None:
+    """从单个 JSON 文件读取英文条目标题列表，失败时返回 None"""
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # 假设格式是 {"rows": [["title1"], ["title2"], ...]}
+        return [row[0] for row in data.get('rows', []) if row and isinstance(row, list) and len(row) > 0 and isinstance(row[0], str)]
+    except FileNotFoundError:
+        pywikibot.error(f"错误：输入文件 {filename} 未找到。")
+    except json.JSONDecodeError:
+        pywikibot.error(f"错误：文件 {filename} 不是有效的 JSON 格式。")
+    except Exception as e:
+        pywikibot.error(f"读取输入文件 {filename} 时发生错误: {e}")
+    return None
+
+def collect_titles(filenames: list[str]) -> list[str] | None:
+    """
+    读取所有输入列表并按规范化标题去重，保持首次出现的顺序。
+    任一文件读取失败时返回 None。
+    """
+    global skipped_duplicate_titles
+    en_titles = []
+    seen = set()
+    for filename in filenames:
+        titles = load_titles_from_file(filename)
+        if titles is None:
+            return None
+        added = 0
+        for title in titles:
+            key = normalize_en_title(title)
+            if not key or key in seen:
+                skipped_duplicate_titles += 1
+                continue
+            seen.add(key)
+            en_titles.append(title)
+            added += 1
+        pywikibot.output(f"从 {filename} 加载了 {len(titles)} 个英文条目标题，其中 {added} 个为新标题。")
+    return en_titles
+
+def parse_args() -> list[str]:
+    """
+    解析命令行参数，返回输入文件列表。支持:
+    -dry 开启 Dry Run 模式；-engine:patch|tree 选择编辑引擎；-verifyengine / -noverifyengine 开启/关闭用树方式校验补丁结果；
+    -workers[:N] 使用 N 个子进程（缺省为 CPU 核数）进行解析和编辑计算；
+    -hostlimit:主机:并发数:速率 调整单个主机的并发和速率上限；
+    -quiet 安静模式；-jsonl:文件 写结构化日志；-logsample:比例 安静模式下抽样输出详细日志；-logdebug 总是输出详细日志；
+    -retries:N 每个处理单元遇到暂时性错误时最多尝试 N 次（1 表示不重试）；
+    -resolver:langlinks|wikidata 选择英文 -> 中文映射的解析后端；
+    -noaliasindex 不使用自动发现的模板别名索引；-refreshaliases 强制重建别名索引；
+    -statusport:端口 开启本地状态端点；-statusfile:文件 定期把运行状态写入文件
+    """
+    global dry_run, edit_engine, verify_edit_engine, process_workers, max_retry_attempts, resolver_backend
+    global use_alias_index, refresh_alias_index, status_port, status_file
+    global quiet_log, log_sample_rate, log_debug, structured_log_file
+    filenames = []
+    for arg in pywikibot.handle_args():
+        if arg == '-dry':
+            dry_run = True
+        elif arg.startswith('-engine:'):
+            engine = arg[len('-engine:'):]
+            if engine in ('patch', 'tree'):
+                edit_engine = engine
+            else:
+                pywikibot.warning(f"未知的编辑引擎 '{engine}'，继续使用 '{edit_engine}'。")
+        elif arg == '-verifyengine':
+            verify_edit_engine = True
+        elif arg == '-noverifyengine':
+            verify_edit_engine = False
+        elif arg == '-workers' or arg.startswith('-workers:'):
+            value = arg[len('-workers:'):] if ':' in arg else ''
+            try:
+                process_workers = int(value) if value else (os.cpu_count() or 1)
+            except ValueError:
+                pywikibot.warning(f"无效的子进程数 '{value}'，将不使用进程池。")
+                process_workers = 0
+        elif arg.startswith('-hostlimit:'):
+            try:
+                host, concurrency, rate = arg[len('-hostlimit:'):].rsplit(':', 2)
+                HOST_LIMITS[host] = (max(int(concurrency), 1), max(float(rate), 0.0))
+            except ValueError:
+                pywikibot.warning(f"无效的主机限制: {arg}（格式: -hostlimit:主机:并发数:速率）")
+        elif arg == '-quiet':
+            quiet_log = True
+        elif arg.startswith('-jsonl:'):
+            structured_log_file = arg[len('-jsonl:'):]
+        elif arg.startswith('-logsample:'):
+            try:
+                log_sample_rate = min(max(float(arg[len('-logsample:'):]), 0.0), 1.0)
+            except ValueError:
+                pywikibot.warning(f"无效的抽样比例: {arg}")
+        elif arg == '-logdebug':
+            log_debug = True
+        elif arg.startswith('-resolver:'):
+            backend = arg[len('-resolver:'):]
+            if backend in ('langlinks', 'wikidata'):
+                resolver_backend = backend
+            else:
+                pywikibot.warning(f"未知的解析后端 '{backend}'，继续使用 '{resolver_backend}'。")
+        elif arg.startswith('-statusport:'):
+            try:
+                status_port = int(arg[len('-statusport:'):])
+            except ValueError:
+                pywikibot.warning(f"无效的状态端点端口: {arg}")
+        elif arg.startswith('-statusfile:'):
+            status_file = arg[len('-statusfile:'):]
+        elif arg == '-noaliasindex':
+            use_alias_index = False
+        elif arg == '-refreshaliases':
+            refresh_alias_index = True
+        elif arg.startswith('-retries:'):
+            try:
+                max_retry_attempts = max(int(arg[len('-retries:'):]), 1)
+            except ValueError:
+                pywikibot.warning(f"无效的重试次数: {arg}")
+        elif arg.startswith('-'):
+            pywikibot.warning(f"忽略未知参数: {arg}")
+        else:
+            filenames.append(arg)
+    return filenames or json_file_paths
+
 # --- 主函数 ---
 def main():
     global processed_counter, edits_made, skipped_no_zh_page, skipped_no_en_talk
     global skipped_en_talk_redirect, skipped_zh_talk_redirect, skipped_no_relevant_en_banners
     global skipped_no_mapping, skipped_no_new_banners, skipped_creation_no_banners
     global error_en_talk_fetch, error_zh_talk_fetch, error_wd_fetch, error_map_fetch
-    global error_zh_save, error_other
-    global template_map_cache
+    global error_zh_save, error_other, skipped_duplicate_pair
+
+    input_files = parse_args()
 
     pywikibot.output("="*30)
-    pywikibot.output("开始执行船舶专题模板同步机器人脚本")
+    pywikibot.output("开始执行专题模板同步机器人脚本")
     pywikibot.output(f"当前时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    pywikibot.output(f"输入列表 ({len(input_files)}): {', '.join(input_files)}")
     pywikibot.output(f"Dry Run 模式: {'是' if dry_run else '否'}")
+    pywikibot.output(f"编辑引擎: {edit_engine}{' (用树方式校验)' if verify_edit_engine and edit_engine == 'patch' else ''}")
+    pywikibot.output(f"映射解析后端: {resolver_backend}{' (未命中时回退到 Wikidata)' if resolver_backend == 'langlinks' else ''}")
     pywikibot.output("="*30 + "\n")
 
-    # 1. 初始化站点
+    # 1. 初始化 HTTP 传输层和站点
+    install_transport()
+    sites_start_time = time.perf_counter()
     if not initialize_sites():
         return # 初始化失败，退出
+    sites_done_time = time.perf_counter()
 
-    # 2. 加载缓存
-    template_map_cache = load_cache(CACHE_FILE)
+    # 2. 加载缓存 (所有列表共用同一份映射缓存和重定向缓存) 和模板别名索引
+    template_map_cache.store = open_cache_store(CACHE_DB_FILE, CACHE_FILE)
+    alias_index = prepare_alias_index() if use_alias_index else None
 
-    # 3. 读取输入文件
-    try:
-        with open(json_file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        # 假设格式是 {"rows": [["title1"], ["title2"], ...]}
-        en_titles = [row[0] for row in data.get('rows', []) if row and isinstance(row, list) and len(row) > 0 and isinstance(row[0], str)]
-        total_titles = len(en_titles)
-        if not en_titles:
-             pywikibot.error(f"错误：在文件 {json_file_path} 中未能找到有效的英文条目标题列表 (检查 'rows' 结构)。脚本将退出。")
-             return
-        pywikibot.output(f"从 {json_file_path} 加载了 {total_titles} 个英文条目标题。")
-    except FileNotFoundError:
-        pywikibot.error(f"错误：输入文件 {json_file_path} 未找到。脚本将退出。")
-        return
-    except json.JSONDecodeError:
-        pywikibot.error(f"错误：文件 {json_file_path} 不是有效的 JSON 格式。脚本将退出。")
-        return
-    except Exception as e:
-        pywikibot.error(f"读取输入文件 {json_file_path} 时发生错误: {e}")
+    # 3. 读取所有输入文件并跨列表去重
+    en_titles = collect_titles(input_files)
+    if en_titles is None:
+        pywikibot.error("读取输入列表失败，脚本将退出。")
         return
-
-    # 4. 循环处理每个标题
+    total_titles = len(en_titles)
+    if not en_titles:
+         pywikibot.error("错误：未能在输入文件中找到有效的英文条目标题列表 (检查 'rows' 结构)。脚本将退出。")
+         return
+    pywikibot.output(f"共 {total_titles} 个待处理的英文条目标题 (跨列表去重跳过 {skipped_duplicate_titles} 个)。")
+    pywikibot.output(f"冷启动耗时: 导入 {_imports_done_time - _script_start_time:.2f} 秒，"
+                     f"站点初始化/登录 (en、zh、Wikidata) {sites_done_time - sites_start_time:.2f} 秒，"
+                     f"开始处理首个标题前共 {time.perf_counter() - _script_start_time:.2f} 秒。")
+
+    # 4. 解析阶段 & 5. 编辑阶段
+    # pending_zh_pages = {中文讨论页标题: (中文页面对象, 合并后的目标模板映射, [英文来源标题])}
+    pending_zh_pages = {}
+    if structured_log_file and not start_structured_log(structured_log_file):
+        return # 日志文件无法打开，退出
+    start_status_reporting()
+    executor = None
+    if process_workers > 0:
+        pywikibot.output(f"使用 {process_workers} 个子进程进行解析和编辑计算。")
+        executor = ProcessPoolExecutor(max_workers=process_workers, initializer=init_worker_process,
+                                       initargs=(alias_index or {},))
     try:
-        for i, en_title in enumerate(en_titles):
-            processed_counter = i + 1
-            pywikibot.output(f"\n--- [{processed_counter}/{total_titles}] 处理英文条目: {en_title} ---")
-            try:
-                process_page(en_title)
-                # 可选：添加短暂延时以降低API请求频率
-                # time.sleep(0.5)
-            except Exception as e: # 捕获 process_page 内部未处理的意外错误
-                 pywikibot.error(f"!!! 在处理 '{en_title}' 时发生顶层未知错误: {e}")
-                 error_other += 1
-                 import traceback; traceback.print_exc()
-            finally:
-                 # 可选：每处理 N 个页面保存一次缓存
-                 if processed_counter % 50 == 0:
-                    save_cache(template_map_cache, CACHE_FILE)
-                 pass
+        resolve_titles(en_titles, pending_zh_pages, executor)
+        pywikibot.output(f"\n解析完成，共有 {len(pending_zh_pages)} 个中文讨论页待处理 (合并了 {merged_en_sources} 个重复指向的英文来源)。")
+        if executor is not None and edit_engine != 'patch':
+            pywikibot.warning("进程池只支持补丁引擎，编辑阶段将在主进程中使用树方式。")
+            edit_zh_pages(pending_zh_pages)
+        else:
+            edit_zh_pages(pending_zh_pages, executor)
 
     finally:
-        # 5. 结束处理，保存缓存并打印统计信息
+        # 6. 结束处理，保存缓存并打印统计信息
         pywikibot.output("\n" + "="*30)
         pywikibot.output("脚本处理完成。")
         pywikibot.output("正在保存最终的模板映射缓存...")
-        save_cache(template_map_cache, CACHE_FILE)
+        save_cache(template_map_cache, close=True)
 
         pywikibot.output("\n--- 统计信息 ---")
         pywikibot.output(f"总共尝试处理条目数: {processed_counter}")
         pywikibot.output(f"成功编辑页面数: {edits_made}")
+        if merged_en_sources: pywikibot.output(f"合并到同一中文讨论页的英文来源数: {merged_en_sources}")
 
         pywikibot.output("\n--- 跳过原因统计 ---")
         skipped_total = (skipped_no_zh_page + skipped_no_en_talk + skipped_en_talk_redirect +
                          skipped_zh_talk_redirect + skipped_no_relevant_en_banners + skipped_no_mapping +
-                         skipped_no_new_banners_or_importance_updates + skipped_creation_no_banners) # 更新计数器名
+                         skipped_no_new_banners_or_importance_updates + skipped_creation_no_banners +
+                         skipped_duplicate_pair) # 更新计数器名
         pywikibot.output(f"总跳过数: {skipped_total}")
         if skipped_no_zh_page: pywikibot.output(f"- 因无法找到对应中文页面或中文页无效/重定向: {skipped_no_zh_page}")
         if skipped_no_en_talk: pywikibot.output(f"- 因英文讨论页不存在: {skipped_no_en_talk}")
@@ -946,6 +2626,8 @@ def main():
         if skipped_no_mapping: pywikibot.output(f"- 因未能将任何英文模板映射到有效的中文模板: {skipped_no_mapping}")
         if skipped_no_new_banners_or_importance_updates: pywikibot.output(f"- 因无需添加新模板且重要性无需更新: {skipped_no_new_banners_or_importance_updates}") # 更新描述
         if skipped_creation_no_banners: pywikibot.output(f"- 因中文讨论页不存在且无需添加模板而跳过创建: {skipped_creation_no_banners}")
+        if skipped_duplicate_pair: pywikibot.output(f"- 因条目对已在本次运行中处理过: {skipped_duplicate_pair}")
+        if skipped_duplicate_titles: pywikibot.output(f"- 因标题在输入列表中重复 (未计入总跳过数): {skipped_duplicate_titles}")
 
 
         pywikibot.output("\n--- 错误统计 ---")
@@ -958,8 +2640,28 @@ def main():
         if error_zh_talk_fetch: pywikibot.output(f"- 获取/解析中文讨论页时出错: {error_zh_talk_fetch}")
         if error_zh_save: pywikibot.output(f"- 保存中文讨论页时出错: {error_zh_save}")
         if error_other: pywikibot.output(f"- 其他/未知处理错误: {error_other}")
+        if patch_engine_mismatches: pywikibot.output(f"- 补丁引擎结果与树方式不一致并已回退 (未计入总错误数): {patch_engine_mismatches}")
+        if retries_scheduled: pywikibot.output(f"- 暂时性错误后安排的重试 (未计入总错误数): {retries_scheduled}，其中重试次数用尽的: {retries_exhausted}，站点级限流暂停: {throttle_pauses} 次")
+
+        if resolver_stats:
+            pywikibot.output("\n--- 映射解析后端统计 ---")
+            for kind, label in (('page', '条目'), ('template', '模板')):
+                if kind in resolver_stats:
+                    pywikibot.output(f"- {label}: " + "，".join(f"{backend} {count}" for backend, count in sorted(resolver_stats[kind].items())))
+
+        pywikibot.output("\n--- 缓存统计 ---")
+        for cache in (template_map_cache, zh_template_redirect_cache, langlinks_cache):
+            pywikibot.output(f"- {cache.stats()}")
+
+        if transport_adapters:
+            pywikibot.output("\n--- HTTP 连接统计 ---")
+            report_transport_stats()
 
         pywikibot.output("="*30)
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        stop_structured_log()
+        stop_status_reporting()
         pywikibot.stopme() # 提示 Pywikibot 脚本结束
 
 # --- 脚本入口 ---